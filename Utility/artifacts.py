@@ -0,0 +1,124 @@
+import os
+import re
+import time
+import logging
+import tempfile
+import threading
+from pathlib import Path
+
+from Utility.caches import CACHE_DIR
+from Utility.metrics import timed
+
+logger = logging.getLogger(__name__)
+
+
+class ArtifactStore:
+    """
+    Bounded on-disk store for rendered maps and their downloadable variants.
+
+    Files are looked up by (map_id, content hash, variant) rather than by path, so
+    any worker on the host can serve a render made by another one. Reading a file
+    refreshes its mtime; eviction removes files older than max_age and then the
+    least recently used ones until the directory is back under max_bytes.
+    """
+
+    def __init__(self, root, max_bytes=256 * 1024 * 1024, max_age=7 * 24 * 3600, evict_interval=30):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_interval = evict_interval
+        self._last_evict = 0
+        self._lock = threading.Lock()
+
+    def _path(self, map_id, content_hash, variant):
+        safe_id = re.sub(r'[^A-Za-z0-9_-]', '_', str(map_id))
+        return self.root / f"{safe_id}_{content_hash}_{variant}"
+
+    @timed('artifact_write')
+    def put(self, map_id, content_hash, variant, data):
+        """Store data (bytes) atomically and return its path."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self._path(map_id, content_hash, variant)
+
+        fd, tmp_name = tempfile.mkstemp(dir=self.root, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_name, path)
+        except OSError:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+
+        self.maybe_evict()
+        return path
+
+    def get_path(self, map_id, content_hash, variant):
+        """Return the path of a stored artifact, or None if it is missing or too old."""
+        path = self._path(map_id, content_hash, variant)
+        try:
+            if time.time() - path.stat().st_mtime > self.max_age:
+                return None
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    @timed('artifact_read')
+    def read(self, map_id, content_hash, variant):
+        path = self.get_path(map_id, content_hash, variant)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except OSError:
+            return None
+
+    def maybe_evict(self):
+        with self._lock:
+            if time.time() - self._last_evict < self.evict_interval:
+                return
+            self._last_evict = time.time()
+        self.evict()
+
+    def evict(self):
+        """Remove expired artifacts, then the least recently used until under max_bytes."""
+        now = time.time()
+        files = []
+        try:
+            entries = list(os.scandir(self.root))
+        except OSError:
+            return
+
+        for entry in entries:
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            # Leftover partial writes are only removed once they are clearly abandoned
+            if entry.name.startswith('.tmp_') and now - st.st_mtime < 3600:
+                continue
+            if now - st.st_mtime > self.max_age or entry.name.startswith('.tmp_'):
+                self._remove(entry.path)
+            else:
+                files.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning("Could not remove map artifact %s: %s", path, e)
+
+
+map_artifacts = ArtifactStore(
+    os.environ.get('MAP_ARTIFACT_DIR') or CACHE_DIR / 'maps',
+    max_bytes=int(os.environ.get('MAP_ARTIFACT_MAX_BYTES', 256 * 1024 * 1024)),
+    max_age=int(os.environ.get('MAP_ARTIFACT_MAX_AGE', 7 * 24 * 3600))
+)
@@ -0,0 +1,226 @@
+import os
+import io
+import re
+import sys
+import json
+import gzip
+import base64
+import hashlib
+import logging
+import zipfile
+import mimetypes
+from pathlib import Path
+from urllib.parse import urljoin, urlsplit
+from urllib.request import urlopen
+
+from Utility.metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Local copies of the CDN assets a map page loads, listed in manifest.json as
+# {url: path relative to the vendor directory}. Filling it is a required
+# deploy step (downloads are refused until every listed file is present):
+#   python -m Utility.bundle fetch     (exits non-zero if anything failed)
+#   python -m Utility.bundle check     (exits non-zero if anything is missing)
+VENDOR_DIR = Path(os.environ.get('MAP_VENDOR_DIR') or Path(__file__).resolve().parent.parent / 'static' / 'vendor')
+MANIFEST_NAME = 'manifest.json'
+
+# Content hashes of vendored files, keyed by (path, mtime_ns, size) so a file
+# is only read again after it changes
+_file_hashes = {}
+
+ASSET_TAG = re.compile(
+    r'<script\b[^>]*\bsrc="(?P<script>https?://[^"]+)"[^>]*>\s*</script>'
+    r'|<link\b(?=[^>]*\brel="stylesheet")[^>]*\bhref="(?P<style>https?://[^"]+)"[^>]*>',
+    re.IGNORECASE
+)
+CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def vendor_path(url):
+    """Where a fetched asset is kept under the vendor directory: host/path of its URL."""
+    parts = urlsplit(url)
+    return f"{parts.netloc}{parts.path}"
+
+
+def strip_query(url):
+    return url.split('#', 1)[0].split('?', 1)[0]
+
+
+class VendoredAssets:
+    """The vendored copies listed in the manifest that are present on disk."""
+
+    def __init__(self, root=VENDOR_DIR):
+        self.root = Path(root)
+        try:
+            self.manifest = json.loads((self.root / MANIFEST_NAME).read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def path(self, url):
+        rel = self.manifest.get(strip_query(url))
+        if rel is None:
+            return None
+        path = self.root / rel
+        return path if path.is_file() else None
+
+    def read(self, url):
+        path = self.path(url)
+        return path.read_bytes() if path is not None else None
+
+    def missing(self):
+        """Manifest URLs whose vendored copy is not on disk (all of them when there is no manifest)."""
+        if not self.manifest:
+            return [f"{self.root / MANIFEST_NAME} (no manifest)"]
+        return sorted(url for url in self.manifest if self.path(url) is None)
+
+    def fingerprint(self):
+        """Changes whenever the manifest or the contents of the files present change, so bundles built from other assets aren't reused."""
+        present = sorted((url, file_hash(p)) for url, p in ((u, self.path(u)) for u in self.manifest) if p)
+        return hashlib.sha256(json.dumps(present).encode('utf-8')).hexdigest()[:12]
+
+
+def file_hash(path):
+    """sha256 of a file's contents, only recomputed when its mtime or size changes."""
+    stat = path.stat()
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+    digest = _file_hashes.get(key)
+    if digest is None:
+        digest = hashlib.sha256(path.read_bytes()).hexdigest()
+        _file_hashes[key] = digest
+    return digest
+
+
+def inline_css(css, css_url, assets):
+    """
+    Point the url()s of a stylesheet inlined from css_url at data: URIs of their
+    vendored copies, or at their absolute CDN URL when there is none (a relative
+    URL stops resolving once the stylesheet is inlined).
+    """
+    def replace(match):
+        ref = match.group(2).strip()
+        if ref.startswith(('data:', '#')):
+            return match.group(0)
+        absolute = urljoin(css_url, ref)
+        path = assets.path(absolute)
+        if path is None:
+            return f'url("{absolute}")'
+        mime = mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+        return f'url("data:{mime};base64,{base64.b64encode(path.read_bytes()).decode("ascii")}")'
+
+    return CSS_URL.sub(replace, css)
+
+
+@timed('bundle_build')
+def build_bundle(html, assets=None):
+    """
+    Make a downloaded map page (bytes) work without the CDNs: every script and
+    stylesheet with a vendored copy is inlined, with the fonts and images its
+    CSS uses as data: URIs, and an asset included more than once is only kept
+    the first time. Map tiles still come from the tile server. Returns bytes.
+
+    Raises RuntimeError if any asset in the manifest hasn't been fetched. A
+    page asset missing from the manifest is logged and keeps loading from its
+    CDN; add it to the manifest and fetch again.
+    """
+    assets = assets or VendoredAssets()
+    missing = assets.missing()
+    if missing:
+        raise RuntimeError(f"{len(missing)} vendored assets missing (run python -m Utility.bundle fetch), "
+                           f"e.g. {missing[0]}")
+    seen = set()
+
+    def replace(match):
+        url = match.group('script') or match.group('style')
+        if url in seen:
+            return ''
+        seen.add(url)
+
+        data = assets.read(url)
+        if data is None:
+            logger.warning("%s is not vendored, so downloaded maps load it from its CDN", url)
+            return match.group(0)
+        text = data.decode('utf-8')
+        if match.group('script'):
+            return '<script>' + re.sub(r'</(script)', r'<\\/\1', text, flags=re.IGNORECASE) + '</script>'
+        text = inline_css(text, url, assets)
+        return '<style>' + re.sub(r'</(style)', r'<\\/\1', text, flags=re.IGNORECASE) + '</style>'
+
+    return ASSET_TAG.sub(replace, html.decode('utf-8')).encode('utf-8')
+
+
+def gzip_bundle(html):
+    return gzip.compress(html, mtime=0)
+
+
+def zip_bundle(html, name='my_roadtrip.html'):
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+        z.writestr(name, html)
+    return out.getvalue()
+
+
+# -------------------------
+# Filling the vendor directory
+# -------------------------
+
+def fetch(urls=None, root=VENDOR_DIR, timeout=30):
+    """
+    Download the assets in the manifest (or urls, which are added to it) into
+    the vendor directory, along with the fonts and images their stylesheets
+    reference, and record everything in the manifest. Returns the manifest and
+    the URLs that could not be downloaded.
+    """
+    root = Path(root)
+    manifest_path = root / MANIFEST_NAME
+    try:
+        manifest = json.loads(manifest_path.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        manifest = {}
+
+    queue = [strip_query(u) for u in (urls or [])] + list(manifest)
+    done = set()
+    failed = []
+    while queue:
+        url = queue.pop(0)
+        if url in done:
+            continue
+        done.add(url)
+        rel = manifest.setdefault(url, vendor_path(url))
+
+        try:
+            with urlopen(url, timeout=timeout) as resp:
+                data = resp.read()
+        except OSError as e:
+            logger.error("Could not fetch %s: %s", url, e)
+            failed.append(url)
+            continue
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+        if rel.endswith('.css'):
+            for _, ref in CSS_URL.findall(data.decode('utf-8', 'replace')):
+                if not ref.startswith(('data:', '#')):
+                    queue.append(strip_query(urljoin(url, ref.strip())))
+
+    root.mkdir(parents=True, exist_ok=True)
+    manifest_path.write_text(json.dumps(manifest, indent=2, sort_keys=True) + '\n', encoding='utf-8')
+    return manifest, failed
+
+
+if __name__ == '__main__':
+    command = sys.argv[1:2]
+    if command == ['fetch']:
+        logging.basicConfig(level=logging.INFO)
+        manifest, failed = fetch(sys.argv[2:])
+        print(f"{len(manifest)} assets listed in {VENDOR_DIR / MANIFEST_NAME}")
+        if failed:
+            sys.exit(f"{len(failed)} assets could not be fetched:\n" + "\n".join(failed))
+    elif command == ['check']:
+        missing = VendoredAssets().missing()
+        if missing:
+            sys.exit(f"{len(missing)} vendored assets missing (run python -m Utility.bundle fetch):\n" + "\n".join(missing))
+        print("All vendored assets present")
+    else:
+        sys.exit("usage: python -m Utility.bundle fetch [url ...] | check")
@@ -0,0 +1,437 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = Path(os.environ.get('ROADTRIP_CACHE_DIR') or Path(__file__).resolve().parent.parent / 'cache')
+
+
+class SqliteStore:
+    """
+    Base for the on-disk caches: one SQLite connection per thread in WAL mode,
+    so every worker process on the host can share the same file.
+    """
+
+    schema = ()
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in self.schema:
+                conn.execute(statement)
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+
+class LegCache(SqliteStore):
+    """
+    On-disk cache of driving legs shared by every worker on the host.
+
+    Entries are keyed by (origin place_id, destination place_id, mode) and hold the
+    distance/duration text, the raw metres/seconds and the encoded overview polyline.
+    Expired entries are dropped on read, and the least recently used entries are
+    evicted once the table grows past max_entries.
+    """
+
+    schema = (
+        """
+        CREATE TABLE IF NOT EXISTS legs (
+            origin TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            distance TEXT,
+            duration TEXT,
+            meters INTEGER,
+            seconds INTEGER,
+            polyline TEXT,
+            expires_at REAL NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (origin, destination, mode)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS legs_last_used ON legs (last_used)",
+    )
+
+    def __init__(self, path, ttl=30 * 24 * 3600, failure_ttl=24 * 3600, max_entries=50000, evict_every=100):
+        super().__init__(path)
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._puts = 0
+        self._lock = threading.Lock()
+
+    def get(self, origin_id, destination_id, mode='driving'):
+        """Return the cached leg dict, or None when missing or expired."""
+        now = time.time()
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT distance, duration, meters, seconds, polyline, expires_at FROM legs "
+                "WHERE origin = ? AND destination = ? AND mode = ?",
+                (origin_id, destination_id, mode)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[5] < now:
+                conn.execute("DELETE FROM legs WHERE origin = ? AND destination = ? AND mode = ?",
+                             (origin_id, destination_id, mode))
+                conn.commit()
+                return None
+            conn.execute("UPDATE legs SET last_used = ? WHERE origin = ? AND destination = ? AND mode = ?",
+                         (now, origin_id, destination_id, mode))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("Leg cache read failed: %s", e)
+            return None
+
+        return {'distance': row[0], 'duration': row[1], 'meters': row[2], 'seconds': row[3], 'polyline': row[4]}
+
+    def put(self, origin_id, destination_id, mode, leg):
+        """Store a leg dict. Legs without a polyline are kept for failure_ttl only."""
+        now = time.time()
+        ttl = self.ttl if leg.get('polyline') else self.failure_ttl
+        try:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO legs "
+                "(origin, destination, mode, distance, duration, meters, seconds, polyline, expires_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (origin_id, destination_id, mode, leg.get('distance'), leg.get('duration'),
+                 leg.get('meters'), leg.get('seconds'), leg.get('polyline'), now + ttl, now)
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("Leg cache write failed: %s", e)
+            return
+
+        with self._lock:
+            self._puts += 1
+            due = self._puts % self.evict_every == 0
+        if due:
+            self.evict()
+
+    def get_many(self, place_ids, mode='driving', chunk=200):
+        """
+        Distances/durations of every cached, unexpired leg between any two of
+        place_ids, as {(origin, destination): {'meters', 'seconds'}}. This is a
+        read-only bulk lookup (polylines aren't read and last_used isn't touched).
+        """
+        wanted = set(place_ids)
+        ids = list(wanted)
+        found = {}
+        try:
+            conn = self._connect()
+            for start in range(0, len(ids), chunk):
+                origins = ids[start:start + chunk]
+                rows = conn.execute(
+                    "SELECT origin, destination, meters, seconds FROM legs "
+                    f"WHERE mode = ? AND expires_at >= ? AND origin IN ({','.join('?' * len(origins))})",
+                    (mode, time.time(), *origins)
+                )
+                for origin, destination, meters, seconds in rows:
+                    if destination in wanted and seconds is not None:
+                        found[(origin, destination)] = {'meters': meters, 'seconds': seconds}
+        except sqlite3.Error as e:
+            logger.warning("Leg cache bulk read failed: %s", e)
+        return found
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones beyond max_entries."""
+        try:
+            conn = self._connect()
+            conn.execute("DELETE FROM legs WHERE expires_at < ?", (time.time(),))
+            count = conn.execute("SELECT COUNT(*) FROM legs").fetchone()[0]
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM legs WHERE rowid IN (SELECT rowid FROM legs ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("Leg cache eviction failed: %s", e)
+
+    def clear(self):
+        try:
+            conn = self._connect()
+            conn.execute("DELETE FROM legs")
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("Leg cache clear failed: %s", e)
+
+
+def normalize_place_name(name):
+    return ' '.join((name or '').split()).casefold()
+
+
+class GeocodeCache(SqliteStore):
+    """
+    Place name -> (place_id, lat, lng) lookups, held in an in-process LRU in front
+    of a shared on-disk table. Names are normalized (case and whitespace) first.
+
+    "No place found" outcomes are cached as (None, None, None) for negative_ttl
+    seconds so a typo is not re-queried on every request, but can still resolve
+    later if Google learns about the place.
+    """
+
+    schema = (
+        """
+        CREATE TABLE IF NOT EXISTS places (
+            name TEXT PRIMARY KEY,
+            place_id TEXT,
+            lat REAL,
+            lng REAL,
+            expires_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS places_expires_at ON places (expires_at)",
+    )
+
+    def __init__(self, path, ttl=90 * 24 * 3600, negative_ttl=3600, memory_size=2048, purge_every=100):
+        super().__init__(path)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory_size = memory_size
+        self.purge_every = purge_every
+        self._puts = 0
+        self._memory = OrderedDict()  # name -> (expires_at, (place_id, lat, lng))
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def _remember(self, name, expires_at, value):
+        with self._lock:
+            self._memory[name] = (expires_at, value)
+            self._memory.move_to_end(name)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _count(self, value, from_disk):
+        with self._lock:
+            self.hits += 1
+            if from_disk:
+                self.disk_hits += 1
+            if value[0] is None:
+                self.negative_hits += 1
+
+    def get(self, place_name):
+        """
+        Return (place_id, lat, lng), (None, None, None) for a cached miss,
+        or None when the name has not been looked up recently.
+        """
+        name = normalize_place_name(place_name)
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(name)
+            if entry is not None:
+                if entry[0] >= now:
+                    self._memory.move_to_end(name)
+                else:
+                    del self._memory[name]
+                    entry = None
+        if entry is not None:
+            self._count(entry[1], from_disk=False)
+            return entry[1]
+
+        try:
+            row = self._connect().execute(
+                "SELECT place_id, lat, lng, expires_at FROM places WHERE name = ?", (name,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Geocode cache read failed: %s", e)
+            row = None
+
+        if row is None or row[3] < now:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        value = (row[0], row[1], row[2])
+        self._remember(name, row[3], value)
+        self._count(value, from_disk=True)
+        return value
+
+    def put(self, place_name, place_id, lat=None, lng=None):
+        """Store a lookup result; pass place_id=None to record that nothing was found."""
+        name = normalize_place_name(place_name)
+        expires_at = time.time() + (self.ttl if place_id else self.negative_ttl)
+        value = (place_id, lat, lng)
+        self._remember(name, expires_at, value)
+        try:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO places (name, place_id, lat, lng, expires_at) VALUES (?, ?, ?, ?, ?)",
+                         (name, place_id, lat, lng, expires_at))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("Geocode cache write failed: %s", e)
+            return
+
+        with self._lock:
+            self._puts += 1
+            due = self._puts % self.purge_every == 0
+        if due:
+            self.purge()
+
+    def purge(self):
+        """Drop expired entries from the on-disk table."""
+        try:
+            conn = self._connect()
+            conn.execute("DELETE FROM places WHERE expires_at < ?", (time.time(),))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("Geocode cache purge failed: %s", e)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'memory_entries': len(self._memory)
+            }
+
+
+class RenderCache:
+    """
+    In-process LRU of rendered map pages keyed by a content hash of everything that
+    goes into the render. Entries are also indexed by (owner_id, map_id) so that
+    a write to a map's stops can drop its renders straight away.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (owner_id, map_id, entry)
+        self._by_map = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[2]
+
+    def put(self, owner_id, map_id, key, entry):
+        """entry is a dict whose 'html' value is the rendered page as bytes."""
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (owner_id, map_id, entry)
+            self._by_map.setdefault((owner_id, map_id), set()).add(key)
+            self._size += len(entry['html'])
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, owner_id, map_id):
+        with self._lock:
+            for key in list(self._by_map.get((owner_id, map_id), ())):
+                self._drop(key)
+
+    def _drop(self, key):
+        owner_id, map_id, entry = self._entries.pop(key)
+        self._size -= len(entry['html'])
+        keys = self._by_map.get((owner_id, map_id))
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_map[(owner_id, map_id)]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self._size}
+
+
+class AclCache:
+    """
+    Short-lived in-process cache of who may access a map, keyed by
+    (owner_id, map_id) and holding {uid: role} for the owner ('owner') and each
+    collaborator. Only the access list is kept, never the map document, so the
+    map's other fields are always read fresh. Entries expire after ttl seconds
+    and must be invalidated whenever a map's collaborators change or the map is
+    deleted.
+    """
+
+    def __init__(self, ttl=30, max_entries=4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (owner_id, map_id) -> (expires_at, {uid: role})
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.request_hits = 0
+        self.misses = 0
+
+    def get(self, owner_id, map_id):
+        key = (owner_id, map_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, owner_id, map_id, roles):
+        with self._lock:
+            self._entries[(owner_id, map_id)] = (time.time() + self.ttl, roles)
+            self._entries.move_to_end((owner_id, map_id))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, owner_id, map_id):
+        with self._lock:
+            self._entries.pop((owner_id, map_id), None)
+
+    def count_request_hit(self):
+        with self._lock:
+            self.request_hits += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'request_hits': self.request_hits,
+                'misses': self.misses,
+                'entries': len(self._entries)
+            }
+
+
+leg_cache = LegCache(
+    os.environ.get('LEG_CACHE_PATH') or CACHE_DIR / 'legs.sqlite3',
+    ttl=int(os.environ.get('LEG_CACHE_TTL', 30 * 24 * 3600)),
+    max_entries=int(os.environ.get('LEG_CACHE_MAX_ENTRIES', 50000))
+)
+
+geocode_cache = GeocodeCache(
+    os.environ.get('GEOCODE_CACHE_PATH') or CACHE_DIR / 'geocode.sqlite3',
+    negative_ttl=int(os.environ.get('GEOCODE_NEGATIVE_TTL', 3600))
+)
+
+render_cache = RenderCache(int(os.environ.get('RENDER_CACHE_MAX_BYTES', 64 * 1024 * 1024)))
+
+acl_cache = AclCache(ttl=int(os.environ.get('ACL_CACHE_TTL', 30)))
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import polyline
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Road distance is longer than the great circle; these turn one into a drive estimate
+DETOUR_FACTOR = float(os.environ.get('LEG_DETOUR_FACTOR', 1.3))
+AVERAGE_SPEED_KMH = float(os.environ.get('LEG_AVERAGE_SPEED_KMH', 70))
+
+
+# (min zoom, tolerance in degrees) for each level of route detail sent to the
+# client, coarse to fine. At the default zoom of 8 a pixel is roughly 0.005
+# degrees, so the level used there stays well below one pixel of error.
+DETAIL_LEVELS = ((0, 0.02), (6, 0.002), (10, 0.0002))
+
+# Tolerance used when only one level can be drawn (the folium fallback)
+FINE_TOLERANCE = DETAIL_LEVELS[-1][1]
+
+
+def simplify(points, tolerance):
+    """
+    Douglas-Peucker simplification of a list/array of (lat, lng) points.
+
+    Longitudes are scaled by cos(latitude) so the tolerance means the same
+    distance in both directions. The distances from every point in a span to
+    its chord are computed in one vectorised step, so the Python loop only
+    runs once per kept point. Returns an (m, 2) array.
+    """
+    pts = np.asarray(points, dtype=float).reshape(-1, 2)
+    n = len(pts)
+    if n < 3 or tolerance <= 0:
+        return pts
+
+    xy = np.column_stack((pts[:, 1] * np.cos(np.radians(pts[:, 0].mean())), pts[:, 0]))
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        start, chord = xy[i], xy[j] - xy[i]
+        offsets = xy[i + 1:j] - start
+        length = np.hypot(chord[0], chord[1])
+        if length == 0:
+            dist = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            dist = np.abs(chord[0] * offsets[:, 1] - chord[1] * offsets[:, 0]) / length
+
+        k = int(np.argmax(dist))
+        if dist[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            stack.append((i, k))
+            stack.append((k, j))
+
+    return pts[keep]
+
+
+def haversine_km(origins, destinations):
+    """
+    Great-circle distances in km between arrays of (lat, lng) points. Shapes
+    broadcast, so (n, 1, 2) against (1, m, 2) gives an (n, m) matrix.
+    """
+    a = np.radians(np.asarray(origins, dtype=float))
+    b = np.radians(np.asarray(destinations, dtype=float))
+    dlat = b[..., 0] - a[..., 0]
+    dlng = b[..., 1] - a[..., 1]
+    h = np.sin(dlat / 2) ** 2 + np.cos(a[..., 0]) * np.cos(b[..., 0]) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def haversine_matrix(points):
+    """(n, n) matrix of great-circle distances in km between every pair of points."""
+    pts = np.asarray(points, dtype=float).reshape(-1, 2)
+    return haversine_km(pts[:, None, :], pts[None, :, :])
+
+
+def estimated_seconds(km, detour_factor=None, speed_kmh=None):
+    """Drive time estimate for great-circle distances (scalar or array) in km."""
+    detour_factor = DETOUR_FACTOR if detour_factor is None else detour_factor
+    speed_kmh = AVERAGE_SPEED_KMH if speed_kmh is None else speed_kmh
+    return np.asarray(km) * detour_factor / speed_kmh * 3600
+
+
+def detail_levels(points):
+    """Encoded polylines of points simplified at each of DETAIL_LEVELS, coarse to fine."""
+    return [polyline.encode(simplify(points, tolerance).tolist()) for _, tolerance in DETAIL_LEVELS]
@@ -2,12 +2,31 @@
 import os
 import json
 
-def insert_buttons(html_path, buttons):
+from Utility.metrics import timed
+
+VIEWPORT_META = "<meta name=\"viewport\" content=\"width=device-width, initial-scale=1.0\">"
+
+
+def compact(code):
     """
-    Appends a stack of buttons to a Folium-generated HTML file.
+    Shrink the HTML/CSS/JS injected into map pages: drop indentation, blank lines
+    and whole-line // and /* */ comments. Line breaks are kept so JS statements
+    that rely on them still parse.
+    """
+    lines = []
+    for line in code.splitlines():
+        line = line.strip()
+        if not line or line.startswith('//') or (line.startswith('/*') and line.endswith('*/')):
+            continue
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def buttons_html(buttons):
+    """
+    Returns the HTML for a stack of buttons to place at the end of the page body.
 
     Parameters:
-    - html_path (str): Path to the HTML file.
     - buttons (list of tuples): Each tuple is (label, href).
     """
     button_container = '''
@@ -44,25 +63,35 @@ def insert_buttons(html_path, buttons):
     </style>
     '''
 
-    buttons_html = "\n".join(
+    links = "\n".join(
         f'<a href="{href}" class="action-button">{label}</a>' for label, href in buttons
     )
 
-    full_html = button_container.format(buttons_html=buttons_html)
+    return compact(button_container.format(buttons_html=links))
+
+
+@timed('html_inject_file')
+def insert_buttons(html_path, buttons):
+    """
+    Appends a stack of buttons to a Folium-generated HTML file.
 
+    Parameters:
+    - html_path (str): Path to the HTML file.
+    - buttons (list of tuples): Each tuple is (label, href).
+    """
     with open(html_path, 'r', encoding='utf-8') as file:
         content = file.read()
 
     # Avoid duplicating if already inserted
     if '<div id="button-container">' not in content:
-        updated_content = content.replace('</body>', full_html + '\n</body>')
+        updated_content = content.replace('</body>', buttons_html(buttons) + '\n</body>')
         with open(html_path, 'w', encoding='utf-8') as file:
             file.write(updated_content)
 
 
-def insert_sidebar(html_path, map_id, owner_id, firebase_config=None):
+def sidebar_html(map_id, owner_id, firebase_config=None):
     """
-    Injects a sidebar for notes into the HTML.
+    Returns the HTML/JS for the notes sidebar.
     Configures Firestore to use users/{owner_id}/maps/{map_id}/planning/notes
     Includes Authentication listener to prevent permission errors on load.
     """
@@ -302,15 +331,38 @@ def insert_sidebar(html_path, map_id, owner_id, firebase_config=None):
     </script>
     """
 
+    return compact(sidebar_code)
+
+
+@timed('html_inject_file')
+def insert_sidebar(html_path, map_id, owner_id, firebase_config=None):
+    """
+    Injects a sidebar for notes into the HTML file.
+    """
     # Inject sidebar code into HTML file
     with open(html_path, "r", encoding="utf-8") as f:
         html = f.read()
         # Ensure mobile responsiveness
         if "<meta name=\"viewport\"" not in html:
-            html = html.replace("<head>", "<head>\n<meta name=\"viewport\" content=\"width=device-width, initial-scale=1.0\">")
+            html = html.replace("<head>", "<head>\n" + VIEWPORT_META)
 
     # Only inject if not already present
     if "id=\"mySidebar\"" not in html:
-        html = html.replace("</body>", sidebar_code + "\n</body>")
+        html = html.replace("</body>", sidebar_html(map_id, owner_id, firebase_config) + "\n</body>")
         with open(html_path, "w", encoding="utf-8") as f:
-            f.write(html)
\ No newline at end of file
+            f.write(html)
+
+
+def split_at_body_end(html):
+    """
+    Splits a rendered page around its closing </body> tag so several variants can
+    be assembled from one render. The viewport meta is added to the head on the way.
+    Returns (before, after).
+    """
+    if "<meta name=\"viewport\"" not in html:
+        html = html.replace("<head>", "<head>\n" + VIEWPORT_META, 1)
+
+    end = html.rfind("</body>")
+    if end == -1:
+        return html, ""
+    return html[:end], html[end:]
\ No newline at end of file
@@ -0,0 +1,165 @@
+import os
+import csv
+import sys
+import codecs
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from Utility.classes import Place
+from Utility.utility_functions import get_place_id
+from Utility.metrics import bind_route
+
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 8))
+
+YES = {'y', 'yes', 'true', '1'}
+
+# Uploads are copied to disk this many bytes at a time
+SPOOL_CHUNK = 64 * 1024
+
+
+def _normalize_header(name):
+    return ' '.join((name or '').replace('_', ' ').split()).casefold()
+
+
+def _float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def place_from_csv_row(row):
+    """
+    Build a Place from one CSV row, using the columns written by write_to_csv
+    (plus optional 'Colour' and 'Type'). Headers are matched case-insensitively.
+    Raises ValueError for rows that cannot be imported.
+    """
+    row = {_normalize_header(k): (v or '').strip() for k, v in row.items() if k is not None}
+
+    name = row.get('name', '')
+    if not name:
+        raise ValueError("missing Name")
+    if '/' in name:
+        raise ValueError("Name may not contain '/'")
+
+    place_type = row.get('type', '').lower()
+    if place_type not in ('poi', 'sleep'):
+        place_type = 'sleep' if row.get('overnight', '').lower() in YES else 'poi'
+
+    place = Place(
+        None, name, row.get('description', ''), row.get('colour') or 'blue',
+        'y' if row.get('include drive', '').lower() in YES else 'n',
+        place_type, row.get('nickname') or name
+    )
+    if row.get('link titles') and row.get('links'):
+        place.link_titles = row['link titles']
+        place.links = row['links']
+
+    lat, lng = _float_or_none(row.get('latitude')), _float_or_none(row.get('longitude'))
+    if row.get('gmaps id') and lat is not None and lng is not None:
+        place.add_geo_data(row['gmaps id'], lat, lng)
+
+    order = _float_or_none(row.get('location id'))
+    return order, place
+
+
+def _geocode(place):
+    if place.gmaps_id is None:
+        place.add_geo_data(*get_place_id(place.name))
+    return place
+
+
+def geocode_places(places, max_workers=IMPORT_WORKERS):
+    """
+    Geocode the places that have no Gmaps ID yet, in place, through a bounded
+    worker pool. Returns one entry per place: None once it has its geo data,
+    or the exception that stopped it from being geocoded.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        jobs = [pool.submit(bind_route(_geocode), place) for place in places]
+    return [job.exception() for job in jobs]
+
+
+def spool_csv_upload(stream, max_bytes):
+    """
+    Copy an uploaded CSV (a binary stream) to a temporary file a chunk at a
+    time, so it can be imported after the request has ended without holding it
+    in memory. The encoding is UTF-8 unless some chunk doesn't decode as that,
+    in which case it is Latin-1. Returns (path, encoding); the caller removes
+    the file. Raises ValueError if the upload is larger than max_bytes.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    encoding = 'utf-8'
+    size = 0
+    fd, path = tempfile.mkstemp(prefix='roadtrip-import-', suffix='.csv')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(SPOOL_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f"CSV larger than {max_bytes} bytes")
+                if encoding == 'utf-8':
+                    try:
+                        decoder.decode(chunk)
+                    except UnicodeDecodeError:
+                        encoding = 'latin-1'
+                out.write(chunk)
+        if encoding == 'utf-8':
+            try:
+                decoder.decode(b'', final=True)
+            except UnicodeDecodeError:
+                encoding = 'latin-1'
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, encoding
+
+
+def import_places(lines, max_workers=IMPORT_WORKERS, progress=None):
+    """
+    Parse CSV text lines and geocode the rows that have no Gmaps ID/lat/lng.
+
+    Rows are handed to a bounded worker pool as soon as they are parsed, so
+    geocoding overlaps with reading the rest of the file. progress, if given,
+    is called with the number of rows done so far as results come in. Returns
+    (places, errors): places in 'Location ID' order (file order for rows
+    without one) and a list of {'line', 'name', 'error'} dicts.
+    """
+    errors = []
+    jobs = []
+    seen = set()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        reader = csv.DictReader(lines)
+        for index, row in enumerate(reader):
+            line = reader.line_num
+            try:
+                order, place = place_from_csv_row(row)
+            except ValueError as e:
+                errors.append({'line': line, 'name': (row.get('Name') or '').strip(), 'error': str(e)})
+                continue
+
+            # Stops are stored under their name, so a repeated name would overwrite the first
+            if place.name in seen:
+                errors.append({'line': line, 'name': place.name, 'error': 'duplicate Name'})
+                continue
+            seen.add(place.name)
+
+            sort_key = (order if order is not None else float('inf'), index)
+            jobs.append((sort_key, line, place, pool.submit(bind_route(_geocode), place)))
+
+        places = []
+        for done, (sort_key, line, place, job) in enumerate(sorted(jobs, key=lambda j: j[0]), 1):
+            try:
+                places.append(job.result())
+            except Exception as e:
+                errors.append({'line': line, 'name': place.name, 'error': str(e)})
+            if progress is not None:
+                progress(done)
+
+    errors.sort(key=lambda e: e['line'])
+    return places, errors
@@ -0,0 +1,373 @@
+import os
+import time
+import datetime
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from firebase_admin import firestore as fb_firestore
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
+
+from Utility.metrics import route_scope
+
+logger = logging.getLogger(__name__)
+
+# Documents listed (and then deleted) per page; progress is saved after each page
+DELETE_PAGE = int(os.environ.get('DELETE_PAGE', 200))
+
+# Write rate for deletions, kept well below what interactive requests need
+DELETE_OPS_PER_SECOND = int(os.environ.get('DELETE_OPS_PER_SECOND', 100))
+
+# Attempts at each delete before it counts as failed, and pages listed per
+# collection before a job gives up (a bound in case deletes stop taking effect)
+DELETE_WRITE_ATTEMPTS = int(os.environ.get('DELETE_WRITE_ATTEMPTS', 10))
+DELETE_MAX_PAGES = int(os.environ.get('DELETE_MAX_PAGES', 5000))
+
+# A worker holds a job for this long after claiming it or finishing a page, so
+# workers of other processes resuming jobs at startup leave it alone; a job is
+# given up (state 'abandoned') after this many claims
+DELETE_LEASE_SECONDS = int(os.environ.get('DELETE_LEASE_SECONDS', 300))
+DELETE_MAX_ATTEMPTS = int(os.environ.get('DELETE_MAX_ATTEMPTS', 5))
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+
+# Maps re-rendered at once after edits; each render can hold several Google requests open
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', 2))
+
+# How long a finished render job's state stays readable by status()/wait()
+RENDER_JOB_TTL = int(os.environ.get('RENDER_JOB_TTL', 300))
+
+# CSV imports run at once; each geocodes through its own bounded pool
+IMPORT_JOB_WORKERS = int(os.environ.get('IMPORT_JOB_WORKERS', 2))
+
+
+class WriteTally:
+    """
+    Counts a bulk writer's successful and failed writes. A failed write is
+    retried until it has been attempted max_attempts times.
+    """
+
+    def __init__(self, writer, max_attempts=DELETE_WRITE_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self._ok = 0
+        self._failed = []
+        self._lock = threading.Lock()
+        writer.on_write_result(self._on_result)
+        writer.on_write_error(self._on_error)
+
+    def _on_result(self, reference, result, writer):
+        with self._lock:
+            self._ok += 1
+
+    def _on_error(self, failure, writer):
+        if failure.attempts < self.max_attempts:
+            return True
+        with self._lock:
+            self._failed.append(f"{failure.operation.reference.path}: {failure.message}")
+        return False
+
+    def take(self):
+        """(succeeded, [failure descriptions]) since the last call."""
+        with self._lock:
+            counts = (self._ok, self._failed)
+            self._ok, self._failed = 0, []
+        return counts
+
+
+class MapDeletionJobs:
+    """
+    Background deletion of everything stored under a map document.
+
+    Deleting a Firestore document leaves its subcollections behind, so when a
+    map is deleted a job is recorded at users/{owner}/deletion_jobs/{map_id}
+    and a worker removes the 'stops', 'planning' (and any other) subcollection
+    documents page by page through a rate-limited bulk writer. Deleted documents
+    don't come back in the next listing, so a job interrupted by a restart just
+    lists again from the start; resume_pending() picks those jobs up.
+
+    Every worker process resumes jobs at startup, so a worker first claims the
+    job in a transaction: it takes a lease (lease_until) that it renews after
+    each page, and counts an attempt. Jobs leased by another worker are
+    skipped, and a job that has used up DELETE_MAX_ATTEMPTS is abandoned.
+
+    resume_pending() queries the deletion_jobs collection group by state,
+    which needs the collection-group index declared in firestore.indexes.json.
+    """
+
+    def __init__(self, db, max_workers=JOB_WORKERS, page_size=DELETE_PAGE, ops_per_second=DELETE_OPS_PER_SECOND):
+        self.db = db
+        self.page_size = page_size
+        self.ops_per_second = ops_per_second
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='map-delete')
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def _job_ref(self, owner_id, map_id):
+        return self.db.collection("users").document(owner_id).collection("deletion_jobs").document(map_id)
+
+    def record(self, owner_id, map_id):
+        """
+        Record a pending deletion job for the map. Call start() once the map
+        document itself is gone, so nothing is deleted from a map that still
+        exists if removing it fails (resume_pending() will still pick the job up).
+        """
+        self._job_ref(owner_id, map_id).set({
+            'map_id': map_id,
+            'state': 'pending',
+            'deleted': 0,
+            'error': None,
+            'attempts': 0,
+            'lease_until': None,
+            'created_at': fb_firestore.SERVER_TIMESTAMP,
+            'updated_at': fb_firestore.SERVER_TIMESTAMP,
+        })
+
+    def start(self, owner_id, map_id):
+        """Run the map's recorded deletion job in the background."""
+        self._submit(owner_id, map_id)
+
+    def status(self, owner_id, map_id):
+        """Return the job document as a dict, or None if the map has no deletion job."""
+        snap = self._job_ref(owner_id, map_id).get()
+        return snap.to_dict() if snap.exists else None
+
+    def resume_pending(self):
+        """
+        Restart jobs left unfinished (or failed) by a previous process. Jobs
+        another worker holds are left to it when claimed. Returns how many were
+        handed to a worker.
+        """
+        count = 0
+        query = self.db.collection_group("deletion_jobs").where("state", "in", ["pending", "running", "failed"])
+        for snap in query.stream():
+            owner_id = snap.reference.parent.parent.id
+            self._submit(owner_id, snap.id)
+            count += 1
+        return count
+
+    def _lease(self):
+        return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=DELETE_LEASE_SECONDS)
+
+    def _claim(self, job_ref):
+        """Take the job for this worker. Returns False if it is finished, leased elsewhere or out of attempts."""
+        @fb_firestore.transactional
+        def claim(transaction):
+            snap = job_ref.get(transaction=transaction)
+            job = snap.to_dict() if snap.exists else None
+            if job is None or job.get('state') not in ('pending', 'running', 'failed'):
+                return False
+            lease_until = job.get('lease_until')
+            if lease_until is not None and lease_until > datetime.datetime.now(datetime.timezone.utc):
+                return False
+            attempts = job.get('attempts') or 0
+            if attempts >= DELETE_MAX_ATTEMPTS:
+                transaction.update(job_ref, {'state': 'abandoned', 'updated_at': fb_firestore.SERVER_TIMESTAMP})
+                return False
+            transaction.update(job_ref, {
+                'state': 'running',
+                'attempts': attempts + 1,
+                'lease_until': self._lease(),
+                'updated_at': fb_firestore.SERVER_TIMESTAMP,
+            })
+            return True
+
+        return claim(self.db.transaction())
+
+    def _submit(self, owner_id, map_id):
+        with self._lock:
+            if (owner_id, map_id) in self._running:
+                return
+            self._running.add((owner_id, map_id))
+        self._pool.submit(self._run_scoped, owner_id, map_id)
+
+    def _run_scoped(self, owner_id, map_id):
+        with route_scope('map_deletion_job'):
+            self._run(owner_id, map_id)
+
+    def _run(self, owner_id, map_id):
+        job_ref = self._job_ref(owner_id, map_id)
+        map_ref = self.db.collection("users").document(owner_id).collection("maps").document(map_id)
+        try:
+            if not self._claim(job_ref):
+                return
+            if map_ref.get(field_paths=[]).exists:
+                # Recorded, but removing the map document itself failed
+                job_ref.update({'state': 'cancelled', 'lease_until': None, 'updated_at': fb_firestore.SERVER_TIMESTAMP})
+                return
+            writer = self.db.bulk_writer(BulkWriterOptions(
+                initial_ops_per_second=self.ops_per_second, max_ops_per_second=self.ops_per_second
+            ))
+            tally = WriteTally(writer)
+            try:
+                for collection in map_ref.collections():
+                    self._delete_collection(collection, writer, tally, job_ref)
+            finally:
+                writer.close()
+            job_ref.update({'state': 'done', 'lease_until': None, 'updated_at': fb_firestore.SERVER_TIMESTAMP})
+        except Exception as e:
+            logger.exception("Deleting map %s/%s failed: %s", owner_id, map_id, e)
+            try:
+                job_ref.update({'state': 'failed', 'error': str(e), 'lease_until': None,
+                                'updated_at': fb_firestore.SERVER_TIMESTAMP})
+            except Exception:
+                logger.exception("Could not record failure of deletion job %s/%s", owner_id, map_id)
+        finally:
+            with self._lock:
+                self._running.discard((owner_id, map_id))
+
+    def _delete_collection(self, collection, writer, tally, job_ref):
+        """
+        Delete every document in collection and below it, one page at a time.
+        Raises if any delete in a page failed, or if the listing stops shrinking.
+        """
+        # recursive() also lists documents of nested subcollections; only their names are needed
+        query = collection.recursive().select([]).limit(self.page_size)
+        previous = None
+        for _ in range(DELETE_MAX_PAGES):
+            page = list(query.stream())
+            if not page:
+                return
+            names = [snap.reference.path for snap in page]
+            if names == previous:
+                raise RuntimeError(f"{collection.id}: the same {len(names)} documents were listed again after deleting them")
+            previous = names
+
+            for snap in page:
+                writer.delete(snap.reference)
+            writer.flush()
+
+            deleted, failed = tally.take()
+            job_ref.update({
+                'deleted': fb_firestore.Increment(deleted),
+                'lease_until': self._lease(),
+                'updated_at': fb_firestore.SERVER_TIMESTAMP,
+            })
+            if failed:
+                raise RuntimeError(f"{len(failed)} deletes failed, e.g. {failed[0]}")
+
+        raise RuntimeError(f"{collection.id}: still not empty after {DELETE_MAX_PAGES} pages")
+
+
+class MapImportJobs:
+    """
+    Background CSV imports, so creating a roadtrip doesn't wait for every row
+    to be geocoded and written.
+
+    run_import(owner_id, map_id, csv_path, encoding) does the work and records
+    its progress (and any failure) in the map's 'import' field, which is what
+    /api/import_status reports. The queue is only held in memory, so an import
+    still queued or running when the process stops is lost; its status stops
+    being refreshed and /api/import_status reports it as failed once it is stale.
+    """
+
+    def __init__(self, run_import, max_workers=IMPORT_JOB_WORKERS):
+        self.run_import = run_import
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='map-import')
+
+    def enqueue(self, owner_id, map_id, csv_path, encoding):
+        self._pool.submit(self._run, owner_id, map_id, csv_path, encoding)
+
+    def _run(self, owner_id, map_id, csv_path, encoding):
+        try:
+            with route_scope('map_import_job'):
+                self.run_import(owner_id, map_id, csv_path, encoding)
+        except Exception as e:
+            logger.exception("Importing into map %s/%s failed: %s", owner_id, map_id, e)
+
+
+class MapRenderJobs:
+    """
+    In-process queue of map re-renders, so the first view after an edit finds
+    the map already rendered.
+
+    render(owner_id, map_id, refresh_legs) does the work. There is at most one
+    job per map: a request for a map that is already queued is merged into
+    that job (it hasn't read the stops yet), and a request for a map that is
+    being rendered makes the job run once more when it finishes, since it may
+    have read the stops before the edit. Job states are kept in memory only, so
+    each worker process has its own queue; finished jobs are forgotten ttl
+    seconds after they finish.
+    """
+
+    def __init__(self, render, max_workers=RENDER_WORKERS, ttl=RENDER_JOB_TTL):
+        self.render = render
+        self.ttl = ttl
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='map-render')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        """Drop jobs that finished more than ttl seconds ago. Call with the lock held."""
+        cutoff = time.time() - self.ttl
+        for key in [key for key, job in self._jobs.items() if job['finished_at'] is not None and job['finished_at'] < cutoff]:
+            del self._jobs[key]
+
+    def enqueue(self, owner_id, map_id, refresh_legs=False):
+        """Ask for the map to be rendered again, bringing its stored legs up to date first if refresh_legs."""
+        key = (owner_id, map_id)
+        with self._lock:
+            self._evict()
+            job = self._jobs.get(key)
+            if job is not None and job['state'] == 'queued':
+                job['refresh_legs'] |= refresh_legs
+                return
+            if job is not None and job['state'] == 'running':
+                job['again'] = True
+                job['again_refresh_legs'] |= refresh_legs
+                return
+            self._jobs[key] = {
+                'state': 'queued',
+                'refresh_legs': refresh_legs,
+                'again': False,
+                'again_refresh_legs': False,
+                'error': None,
+                'queued_at': time.time(),
+                'finished_at': None,
+                'done': threading.Event(),
+            }
+        self._pool.submit(self._run, key)
+
+    def status(self, owner_id, map_id):
+        """State of the map's latest job: 'idle' (not queued here within the last ttl seconds), 'queued', 'running', 'done' or 'failed'."""
+        with self._lock:
+            self._evict()
+            job = self._jobs.get((owner_id, map_id))
+            if job is None:
+                return {'state': 'idle'}
+            return {k: job[k] for k in ('state', 'error', 'queued_at', 'finished_at')}
+
+    def wait(self, owner_id, map_id, timeout=None):
+        """Wait for a queued or running job of the map to finish. Returns False on timeout."""
+        with self._lock:
+            job = self._jobs.get((owner_id, map_id))
+        if job is None:
+            return True
+        return job['done'].wait(timeout)
+
+    def _run(self, key):
+        owner_id, map_id = key
+        with self._lock:
+            job = self._jobs[key]
+            job['state'] = 'running'
+            refresh_legs = job['refresh_legs']
+
+        error = None
+        try:
+            with route_scope('map_render_job'):
+                self.render(owner_id, map_id, refresh_legs)
+        except Exception as e:
+            logger.exception("Rendering map %s/%s failed: %s", owner_id, map_id, e)
+            error = str(e)
+
+        with self._lock:
+            if job['again']:
+                # Edited while rendering: render once more with the new stops
+                job.update(state='queued', refresh_legs=job['again_refresh_legs'],
+                           again=False, again_refresh_legs=False)
+                try:
+                    self._pool.submit(self._run, key)
+                    return
+                except RuntimeError:
+                    pass  # shutting down
+            job.update(state='failed' if error else 'done', error=error, finished_at=time.time())
+            job['done'].set()
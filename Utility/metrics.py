@@ -0,0 +1,359 @@
+import os
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+
+try:
+    from flask import has_request_context, request
+except ImportError:  # metrics are still recorded outside the web app, just without a route
+    has_request_context = lambda: False
+    request = None
+
+# Upper bounds (seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+class Counter:
+    """Monotonic counter with labels, exported in the Prometheus text format."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def lines(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(zip(self.labelnames, key))} {value}'
+
+
+class Histogram(Counter):
+    """Histogram of observed durations with labels, exported in the Prometheus text format."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def lines(self):
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        for key, (counts, total, count) in sorted(values.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket{_format_labels(labels + [("le", bound)])} {cumulative}'
+            yield f'{self.name}_bucket{_format_labels(labels + [("le", "+Inf")])} {count}'
+            yield f'{self.name}_sum{_format_labels(labels)} {total}'
+            yield f'{self.name}_count{_format_labels(labels)} {count}'
+
+
+class Registry:
+    """
+    The metrics of this process. Each worker process keeps its own, so a
+    scraper sees the worker that answered; label the scrape target accordingly.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        out = []
+        for metric in self._metrics:
+            out.append(f'# HELP {metric.name} {metric.documentation}')
+            out.append(f'# TYPE {metric.name} {metric.kind}')
+            out.extend(metric.lines())
+        return '\n'.join(out) + '\n'
+
+
+registry = Registry()
+
+http_request_seconds = registry.histogram(
+    'roadtrip_http_request_seconds', 'Time to handle a request.', ('route', 'method', 'status'))
+gmaps_request_seconds = registry.histogram(
+    'roadtrip_gmaps_request_seconds', 'Time spent in Google Maps API calls.', ('route', 'method', 'status'))
+firestore_request_seconds = registry.histogram(
+    'roadtrip_firestore_request_seconds', 'Time spent in Firestore calls.', ('route', 'op'))
+firestore_documents = registry.counter(
+    'roadtrip_firestore_documents_total', 'Firestore documents read or written.', ('route', 'kind'))
+stage_seconds = registry.histogram(
+    'roadtrip_stage_seconds', 'Time spent rendering maps, injecting HTML and reading/writing files.', ('route', 'stage'))
+
+
+# -------------------------
+# Route labels
+# -------------------------
+
+_local = threading.local()
+
+
+def current_route():
+    """The Flask endpoint being served, the route bound to this thread, or 'background'."""
+    route = getattr(_local, 'route', None)
+    if route:
+        return route
+    if has_request_context():
+        return request.endpoint or 'unknown'
+    return 'background'
+
+
+@contextmanager
+def route_scope(route):
+    """Label everything recorded on this thread inside the block with route."""
+    previous = getattr(_local, 'route', None)
+    _local.route = route
+    try:
+        yield
+    finally:
+        _local.route = previous
+
+
+def bind_route(fn):
+    """Wrap fn so it records under the calling thread's route when run on a worker thread."""
+    route = current_route()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with route_scope(route):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def stage_timer(stage):
+    with stage_seconds.time(route=current_route(), stage=stage):
+        yield
+
+
+def timed(stage):
+    """Decorator recording each call of the function as `stage` in roadtrip_stage_seconds."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# -------------------------
+# Google Maps
+# -------------------------
+
+class InstrumentedClient:
+    """Proxy for a googlemaps.Client that times the calls the app makes."""
+
+    METHODS = ('find_place', 'distance_matrix', 'directions')
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in self.METHODS:
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            status = 'ok'
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            except Exception:
+                status = 'error'
+                raise
+            finally:
+                gmaps_request_seconds.observe(time.perf_counter() - start,
+                                              route=current_route(), method=name, status=status)
+        return call
+
+
+# -------------------------
+# Firestore
+# -------------------------
+
+_firestore_instrumented = False
+
+
+def _record_firestore(op, kind, documents, start):
+    route = current_route()
+    firestore_request_seconds.observe(time.perf_counter() - start, route=route, op=op)
+    if documents:
+        firestore_documents.inc(documents, route=route, kind=kind)
+
+
+@contextmanager
+def firestore_timer(op, kind, documents):
+    """Record the block as one Firestore call that reads or writes documents (for the app's own helpers)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_firestore(op, kind, documents, start)
+
+
+def _wrap_call(cls, method, op, kind, documents):
+    original = getattr(cls, method, None)
+    if original is None:
+        return
+
+    @functools.wraps(original)
+    def wrapper(self, *args, **kwargs):
+        count = documents(self)
+        start = time.perf_counter()
+        try:
+            return original(self, *args, **kwargs)
+        finally:
+            _record_firestore(op, kind, count, start)
+    setattr(cls, method, wrapper)
+
+
+class TimedStream:
+    """
+    Iterator over a Firestore stream that records the time spent fetching its
+    items (not the caller's time between them) and how many there were, once
+    the stream is exhausted, fails or is closed. Other attributes, such as
+    StreamGenerator.get_explain_metrics(), are those of the wrapped stream.
+    """
+
+    def __init__(self, stream, op, elapsed=0.0):
+        self._stream = stream
+        self._iterator = iter(stream)
+        self._op = op
+        self._route = current_route()
+        self._elapsed = elapsed
+        self._count = 0
+        self._recorded = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            item = next(self._iterator)
+        except BaseException:
+            self._elapsed += time.perf_counter() - start
+            self._record()
+            raise
+        self._elapsed += time.perf_counter() - start
+        self._count += 1
+        return item
+
+    def close(self):
+        self._record()
+        close = getattr(self._stream, 'close', None)
+        if close is not None:
+            close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._stream, name)
+
+    def __del__(self):
+        self._record()
+
+    def _record(self):
+        if self._recorded:
+            return
+        self._recorded = True
+        firestore_request_seconds.observe(self._elapsed, route=self._route, op=self._op)
+        if self._count:
+            firestore_documents.inc(self._count, route=self._route, kind='read')
+
+
+def _wrap_stream(cls, method, op):
+    original = getattr(cls, method, None)
+    if original is None:
+        return
+
+    @functools.wraps(original)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        stream = original(self, *args, **kwargs)
+        return TimedStream(stream, op, elapsed=time.perf_counter() - start)
+    setattr(cls, method, wrapper)
+
+
+def instrument_firestore():
+    """
+    Time the Firestore client's reads and single-document writes, and count the
+    documents they touch, by wrapping public methods of the client classes
+    (once per process; a method missing from the installed SDK is skipped).
+    Batched and transactional writes are recorded by the app's own helpers
+    with firestore_timer(). Set METRICS_FIRESTORE=off to leave the client
+    untouched.
+    """
+    global _firestore_instrumented
+    if _firestore_instrumented or os.environ.get('METRICS_FIRESTORE', 'on') == 'off':
+        return
+    _firestore_instrumented = True
+
+    from google.cloud.firestore_v1.client import Client
+    from google.cloud.firestore_v1.document import DocumentReference
+    from google.cloud.firestore_v1.query import Query
+
+    _wrap_call(DocumentReference, 'get', 'get', 'read', lambda self: 1)
+    for method in ('set', 'update', 'create', 'delete'):
+        _wrap_call(DocumentReference, method, method, 'write', lambda self: 1)
+    # Query.get and CollectionReference.stream/get all go through Query.stream
+    _wrap_stream(Query, 'stream', 'query')
+    _wrap_stream(Client, 'get_all', 'get_all')
@@ -0,0 +1,141 @@
+from bisect import bisect_left
+
+
+# Spacing between stop ids handed out when there is no upper neighbour, so later
+# moves into the gap don't have to renumber anything else
+SEQ_GAP = 1000
+
+# When fitting moved stops between their neighbours needs more renumbered
+# stops than this, the whole trip is respaced by SEQ_GAP instead (once)
+RESPACE_AFTER = 32
+
+
+def increasing_subsequence(values):
+    """Indexes of one longest strictly increasing subsequence of values."""
+    tails = []      # tails[k]: index of the smallest tail of an increasing run of length k + 1
+    tail_values = []
+    previous = [-1] * len(values)
+
+    for i, value in enumerate(values):
+        k = bisect_left(tail_values, value)
+        if k:
+            previous[i] = tails[k - 1]
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[k] = i
+            tail_values[k] = value
+
+    out = []
+    i = tails[-1] if tails else -1
+    while i != -1:
+        out.append(i)
+        i = previous[i]
+    return out[::-1]
+
+
+def desired_order(current, order=None, move=None, before=None):
+    """
+    Return the full list of doc ids in their new order.
+
+    current is the list of doc ids in their present order. Either order (a list
+    of doc ids; unknown ids are ignored and unlisted stops keep their relative
+    order after the listed ones) or move/before (move one doc id in front of
+    another, or to the end when before is None) describes the change.
+    Raises KeyError if move or before is not a current stop.
+    """
+    if move is not None:
+        if move not in current or (before is not None and before not in current):
+            raise KeyError(move if move not in current else before)
+        if before == move:
+            return list(current)
+        out = [d for d in current if d != move]
+        out.insert(out.index(before) if before is not None else len(out), move)
+        return out
+
+    known = set(current)
+    out = list(dict.fromkeys(d for d in order or [] if d in known))
+    listed = set(out)
+    return out + [d for d in current if d not in listed]
+
+
+def plan_reorder(ids, desired):
+    """
+    Work out which stops need a new id for the ordering in desired.
+
+    ids maps doc id -> current stop id and desired lists every doc id in its new
+    order. The longest run of stops whose ids are already increasing keeps its
+    ids; the rest get ids spaced between their kept neighbours, widening the
+    window over neighbouring stops (alternately after and before it) when there
+    isn't enough room. Ids never go below 1: stops moved to the front share the
+    room below the first kept id. Returns a dict of doc id -> new id containing
+    only the stops that change.
+    """
+    values = [ids[d] for d in desired]
+    n = len(values)
+    keep = [False] * n
+    for i in increasing_subsequence(values):
+        keep[i] = True
+
+    def fits(a, b):
+        if b == n:
+            return True
+        lo = values[a - 1] if a > 0 else 0
+        return values[b] - lo - 1 >= b - a
+
+    windows = []
+    i = 0
+    while i < n:
+        if keep[i]:
+            i += 1
+            continue
+
+        a = b = i
+        while b < n and not keep[b]:
+            b += 1
+
+        absorbed = 0
+        while not fits(a, b):
+            if absorbed % 2 == 0 or a == 0:
+                keep[b] = False
+                while b < n and not keep[b]:
+                    b += 1
+            else:
+                keep[a - 1] = False
+                while a > 0 and not keep[a - 1]:
+                    a -= 1
+            absorbed += 1
+        if absorbed > RESPACE_AFTER:
+            return respace(values, desired)
+
+        # Widening backwards may have swallowed earlier windows
+        while windows and windows[-1][0] >= a:
+            windows.pop()
+        windows.append((a, b))
+        i = b
+
+    changes = {}
+    for a, b in windows:
+        count = b - a
+        lo = values[a - 1] if a > 0 else 0
+        hi = values[b] if b < n else None
+        if hi is None:
+            new_ids = [lo + SEQ_GAP * (k + 1) for k in range(count)]
+        else:
+            step = (hi - lo) // (count + 1)
+            new_ids = [lo + step * (k + 1) for k in range(count)]
+
+        for k, new_id in enumerate(new_ids):
+            if new_id != values[a + k]:
+                changes[desired[a + k]] = new_id
+
+    # Renumbering most of the trip anyway: respace it so ids stay small and evenly gapped
+    if len(changes) > n // 2:
+        return respace(values, desired)
+    return changes
+
+
+def respace(values, desired):
+    """Changes that renumber every stop in desired order, SEQ_GAP apart."""
+    return {d: SEQ_GAP * (k + 1) for k, d in enumerate(desired) if values[k] != SEQ_GAP * (k + 1)}
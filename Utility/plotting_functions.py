@@ -1,5 +1,16 @@
 import folium
 import ast
+import json
+from pathlib import Path
+from functools import lru_cache
+
+from branca.element import Element, MacroElement, JavascriptLink, CssLink
+from folium.plugins import MarkerCluster
+
+RENDERER_JS = Path(__file__).resolve().parent.parent / 'static' / 'js' / 'map_renderer.js'
+
+# Dash pattern of legs drawn as a straight line for want of a route (map_renderer.js uses the same)
+UNROUTED_DASH = '8 8'
 
 def numbered_pin_html(number, color):
     return f"""
@@ -25,13 +36,15 @@ def numbered_pin_html(number, color):
     """
     
     
-def add_route_segment(map_obj, locations, distance, duration, color="blue", weight=3, opacity=0.8):
+def add_route_segment(map_obj, locations, distance, duration, color="blue", weight=3, opacity=0.8, estimated=False, routed=True):
+    # Straight lines standing in for a route are dashed so they aren't mistaken for real routes
     folium.PolyLine(
         locations=locations,
         color=color,
         weight=4,
         opacity=opacity,
-        popup=folium.Popup(popup_for_drives(distance, duration), max_width=300)
+        dash_array=None if routed else UNROUTED_DASH,
+        popup=folium.Popup(popup_for_drives(distance, duration, estimated, routed), max_width=300)
     ).add_to(map_obj)
 
 
@@ -51,13 +64,22 @@ def popup_for_places(location_name, link_titles, links, description):
     return html_content
 
 
-def popup_for_drives(distance, duration):
+def popup_for_drives(distance, duration, estimated=False, routed=True):
+    """
+    Popup of a leg. routed=False: no route geometry, so the line drawn is straight;
+    estimated=True: the distance and duration are estimates, not Google's.
+    """
     html_lines = f'<b>Duration</b>: {duration} <br> <b>Distance</b>: {distance}'
+    if not routed:
+        html_lines += ' <br> <i>No route available, shown as a straight line</i>'
+    if estimated:
+        html_lines += ' <br> <i>Distance and duration estimated</i>'
     return html_lines
 
 
 
 def add_pin(m, trip):
+    """Adds a marker per place to m, which may be the map itself or a MarkerCluster on it."""
 
     for (i, place) in enumerate(trip.places.values()):
         if place.drive == 'y':
@@ -82,30 +104,73 @@ def add_pin(m, trip):
             
 
 
-    # keys = list(trip.places.keys())
-    # symbol = trip.get_place(keys[0]).inc_drive
-    
-    # if symbol == 'y':
-    #     for i, place in enumerate(trip.places.values()):
-    #         folium.Marker(
-    #             location=[place.lat, place.lng],
-    #             popup=folium.Popup(popup_for_places(place.nickname, place.link_titles, place.links, place.desc), max_width=300),
-    #             icon=folium.DivIcon(html=numbered_pin_html(i + 1, place.colour), icon_size=(30, 30), icon_anchor=(15, 30))
-    #     ).add_to(m)
-            
-    # else:
-    #     if symbol == 'n':
-    #         icon = folium.Icon(icon="info-sign", prefix="glyphicon")
-            
-    #     else: # symbol=='p'
-    #         icon = folium.DivIcon(html=numbered_pin_html('p', '#58AADE'), icon_size=(30, 30), icon_anchor=(15, 30))
-            
-    #     for i, place in enumerate(trip.places.values()):
-    #         folium.Marker(
-    #             location=[place.lat, place.lng],
-    #             popup=folium.Popup(popup_for_places(place.nickname, place.link_titles, place.links, place.desc), max_width=300),
-    #             icon=icon
-    #     ).add_to(m)
-
-                
-        
\ No newline at end of file
+
+
+def stop_payload(place, number=None):
+    """Compact [lat, lng, number, colour, kind, popup] entry for the client-side renderer."""
+    return [
+        float(place.lat), float(place.lng), number, place.colour, place.place_type,
+        popup_for_places(place.nickname, place.link_titles, place.links, place.desc)
+    ]
+
+
+def trip_payload(driving_stops, other_stops, legs, routes, cluster=False, zooms=(0,)):
+    """
+    Everything the client-side renderer needs in one dict. routes[i] is either a
+    list of [lat, lng] points or the encoded polylines of legs[i] at each detail
+    level, shown from the matching zoom in zooms onwards.
+    With cluster=True the non-driving stops are grouped into marker clusters.
+    """
+    stops = [stop_payload(place, i + 1) for i, place in enumerate(driving_stops.places.values())]
+    stops += [stop_payload(place) for place in other_stops.places.values()]
+    return {
+        'stops': stops,
+        'legs': [[route, leg['distance'], leg['duration'], bool(leg.get('estimated')), bool(leg.get('polyline'))]
+                 for leg, route in zip(legs, routes)],
+        'cluster': cluster,
+        'zooms': list(zooms)
+    }
+
+
+@lru_cache(maxsize=1)
+def renderer_js():
+    return RENDERER_JS.read_text(encoding='utf-8')
+
+
+class RawScript(Element):
+    """
+    Script text added to the page verbatim. Plain branca Elements are parsed as
+    Jinja templates, which breaks on encoded polylines containing '{{' or '{%'.
+    """
+
+    def __init__(self, text):
+        super().__init__()
+        self.text = text
+
+    def render(self, **kwargs):
+        return self.text
+
+
+class TripLayer(MacroElement):
+    """Ships a trip as one JSON payload and draws it in the browser with map_renderer.js."""
+
+    def __init__(self, payload):
+        super().__init__()
+        self._name = 'TripLayer'
+        self.cluster = payload.get('cluster', False)
+        # Keep '</script>' inside popup text from closing the script block
+        self.payload = json.dumps(payload, separators=(',', ':')).replace('</', '<\\/')
+
+    def render(self, **kwargs):
+        figure = self.get_root()
+        if self.cluster:
+            for name, url in MarkerCluster.default_js:
+                figure.header.add_child(JavascriptLink(url), name=name)
+            for name, url in MarkerCluster.default_css:
+                figure.header.add_child(CssLink(url), name=name)
+
+        figure.script.add_child(RawScript(renderer_js()), name='trip_renderer')
+        figure.script.add_child(
+            RawScript(f"renderTrip({self._parent.get_name()}, {self.payload});"),
+            name=self.get_name()
+        )
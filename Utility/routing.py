@@ -0,0 +1,154 @@
+import time
+
+import numpy as np
+
+# Moves must save at least this much (seconds) to count as an improvement
+EPSILON = 1e-6
+
+# Longest run of consecutive stops Or-opt tries to move elsewhere
+OR_OPT_MAX_SEGMENT = 3
+
+
+def route_cost(order, cost, loop=True):
+    """Total cost of visiting order (indices into cost), closing the loop if asked."""
+    order = np.asarray(order)
+    total = cost[order[:-1], order[1:]].sum()
+    if loop and len(order) > 1:
+        total += cost[order[-1], order[0]]
+    return float(total)
+
+
+def nearest_neighbour(cost):
+    """Path from node 0 to node m-1 that always moves to the closest unvisited node in between."""
+    m = len(cost)
+    visited = np.zeros(m, dtype=bool)
+    visited[0] = visited[m - 1] = True
+    order = [0]
+    for _ in range(m - 2):
+        row = np.where(visited, np.inf, cost[order[-1]])
+        nxt = int(np.argmin(row))
+        visited[nxt] = True
+        order.append(nxt)
+    order.append(m - 1)
+    return np.array(order)
+
+
+def best_two_opt(t, cost):
+    """
+    Best reversal of a segment t[i..j] (endpoints fixed) as (delta, i, j). The
+    cost matrix may be asymmetric, so reversed segments are costed both ways
+    using prefix sums of forward and backward edge costs.
+    """
+    m = len(t)
+    if m < 4:
+        return 0.0, 0, 0
+    forward = np.concatenate(([0.0], np.cumsum(cost[t[:-1], t[1:]])))
+    backward = np.concatenate(([0.0], np.cumsum(cost[t[1:], t[:-1]])))
+
+    i = np.arange(1, m - 1)[:, None]
+    j = np.arange(1, m - 1)[None, :]
+    old = cost[t[i - 1], t[i]] + (forward[j] - forward[i]) + cost[t[j], t[j + 1]]
+    new = cost[t[i - 1], t[j]] + (backward[j] - backward[i]) + cost[t[i], t[j + 1]]
+    delta = np.where(j > i, new - old, np.inf)
+
+    k = int(np.argmin(delta))
+    a, b = divmod(k, m - 2)
+    return float(delta.flat[k]), a + 1, b + 1
+
+
+def best_or_opt(t, cost):
+    """
+    Best move of a run of 1..OR_OPT_MAX_SEGMENT stops t[i..i+L-1] to between
+    t[k] and t[k+1], as (delta, i, L, k).
+    """
+    m = len(t)
+    best = (0.0, 0, 0, 0)
+    edge = cost[t[:-1], t[1:]]
+    for length in range(1, OR_OPT_MAX_SEGMENT + 1):
+        if m - 2 < length + 1:
+            break
+        i = np.arange(1, m - length)          # segment starts with both neighbours inside the path
+        first, last = t[i], t[i + length - 1]
+        before, after = t[i - 1], t[i + length]
+        removal_gain = cost[before, first] + cost[last, after] - cost[before, after]
+
+        k = np.arange(m - 1)[None, :]         # insert on edge t[k] -> t[k+1]
+        insert = cost[t[k], first[:, None]] + cost[last[:, None], t[k + 1]] - edge[k]
+        delta = insert - removal_gain[:, None]
+        # The edges touching the segment itself are not places to move it to
+        inside = (k >= i[:, None] - 1) & (k <= i[:, None] + length - 1)
+        delta = np.where(inside, np.inf, delta)
+
+        idx = int(np.argmin(delta))
+        r, c = divmod(idx, m - 1)
+        if delta.flat[idx] < best[0]:
+            best = (float(delta.flat[idx]), int(i[r]), length, int(c))
+    return best
+
+
+def improve(t, cost, deadline):
+    """Apply the best 2-opt or Or-opt move until neither helps or time runs out."""
+    while time.perf_counter() < deadline:
+        delta, i, j = best_two_opt(t, cost)
+        if delta < -EPSILON:
+            t = np.concatenate((t[:i], t[i:j + 1][::-1], t[j + 1:]))
+            continue
+
+        delta, i, length, k = best_or_opt(t, cost)
+        if delta < -EPSILON:
+            segment = t[i:i + length]
+            rest = np.concatenate((t[:i], t[i + length:]))
+            # position of edge k's tail in the path without the segment
+            k = k if k < i else k - length
+            t = np.concatenate((rest[:k + 1], segment, rest[k + 1:]))
+            continue
+        break
+    return t
+
+
+def optimize_order(cost, loop=True, start=0, end=None, time_budget=0.5):
+    """
+    Find a good visiting order for the n stops of an (n, n) cost matrix.
+
+    With loop=True the route returns to `start` after the last stop. Otherwise it
+    runs from `start` to `end`; either may be None to let the solver choose.
+    Nearest-neighbour construction is refined with 2-opt and Or-opt moves for
+    at most time_budget seconds. Returns the order as a list of stop indices.
+    """
+    deadline = time.perf_counter() + time_budget
+    cost = np.asarray(cost, dtype=float)
+    n = len(cost)
+    if n <= 2:
+        order = list(range(n))
+        if n == 2 and (start == 1 or end == 0):
+            order.reverse()
+        return order
+
+    # Turn every case into a path between two fixed nodes: a loop ends at a copy
+    # of its start, and a free end is a dummy node that is free to reach/leave.
+    size = n + 2
+    ext = np.zeros((size, size))
+    ext[:n, :n] = cost
+    head, tail = n, n + 1
+    if loop:
+        start = 0 if start is None else start
+        end = None
+        ext[head, :n] = cost[start]
+        ext[:n, tail] = cost[:, start]
+    else:
+        if start is not None:
+            ext[head, :n] = cost[start]
+        if end is not None:
+            ext[:n, tail] = cost[:, end]
+    ext[head, tail] = ext[tail, head] = np.inf
+
+    inner = [s for s in range(n) if s not in (start, end)]
+    nodes = np.array([head] + inner + [tail])
+    sub = ext[np.ix_(nodes, nodes)]
+
+    t = improve(nearest_neighbour(sub), sub, deadline)
+    order = [int(nodes[k]) for k in t[1:-1]]
+
+    if loop:
+        return [start] + order
+    return ([start] if start is not None else []) + order + ([end] if end is not None else [])
@@ -2,23 +2,39 @@ import googlemaps
 import os
 import csv
 import sys
+import time
+import logging
+import threading
+import numpy as np
 import polyline
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from Utility.classes import *
 from Utility.plotting_functions import *
+from Utility.caches import leg_cache, geocode_cache
+from Utility.geometry import simplify, haversine_km, estimated_seconds, FINE_TOLERANCE, DETOUR_FACTOR
+from Utility.metrics import InstrumentedClient, bind_route
 
 from dotenv import load_dotenv
 
 env_path = Path(__file__).resolve().parent.parent / '.env'
 load_dotenv(dotenv_path=env_path)
+logger = logging.getLogger(__name__)
+
 gmaps_key = os.environ.get('GOOGLE_MAPS_KEY', '')
-gmaps = googlemaps.Client(key=gmaps_key)
+gmaps = InstrumentedClient(googlemaps.Client(key=gmaps_key))
 
 
 
 def get_place_id(place_name): 
+    cached = geocode_cache.get(place_name)
+    if cached is not None:
+        if cached[0] is None:
+            raise Exception(f"No place found for '{place_name}'")
+        return cached
+
     result = gmaps.find_place(
         input=place_name,
         input_type='textquery',
@@ -27,12 +43,14 @@ def get_place_id(place_name):
     
     candidates = result.get('candidates', [])
     if not candidates:
+        geocode_cache.put(place_name, None)
         raise Exception(f"No place found for '{place_name}'")
     
     location = candidates[0]['geometry']['location']
     lat = location['lat']
     lng = location['lng']
 
+    geocode_cache.put(place_name, candidates[0]['place_id'], lat, lng)
     return candidates[0]['place_id'], lat, lng
 
 
@@ -62,65 +80,232 @@ def add_colours(stops):
 
     
     
-def get_distance(loc_ids, i, mode='driving'):
-    if i == 'final':
-        i = -1
-        j = 0
-    else:
-        j = i + 1
-    origin_id = loc_ids[i]
-    destination_id = loc_ids[j]
-    
-    result = gmaps.distance_matrix(
-        origins=[f'place_id:{origin_id}'],
-        destinations=[f'place_id:{destination_id}'],
-        mode='driving',
-        units='metric'
-    )
-
-    if result['rows'][0]['elements'][0]['status'] == 'ZERO_RESULTS':
-        duration = 'na'
-        distance = 'na'
-        
-    else:
-        duration = result['rows'][0]['elements'][0]['duration']['text']
-        distance = result['rows'][0]['elements'][0]['distance']['text']
-        
-    directions = gmaps.directions(
+def fetch_leg(origin_id, destination_id, mode='driving', client=None):
+    """
+    Ask Google for the distance, duration and overview polyline of a single leg,
+    all from one Directions request. Returns a leg dict; a failed leg when no
+    route was found.
+    """
+    client = client or gmaps
+    directions = client.directions(
         origin=f"place_id:{origin_id}",
         destination=f"place_id:{destination_id}",
-        mode="driving")
-        
-    if directions:
-        # Extract and decode the route polyline
-        route_polyline = directions[0]['overview_polyline']['points']
-        decoded_route = polyline.decode(route_polyline)
-        route_type = "actual"
-    else:
-        decoded_route = 'failed'
-    
-    return distance, duration, decoded_route
+        mode=mode)
+    if not directions:
+        return failed_leg()
+
+    route = directions[0]
+    leg = route['legs'][0]
+    return {
+        'distance': leg['distance']['text'],
+        'duration': leg['duration']['text'],
+        'meters': leg['distance']['value'],
+        'seconds': leg['duration']['value'],
+        'polyline': route['overview_polyline']['points']
+    }
+
+
+def failed_leg():
+    return {'distance': 'na', 'duration': 'na', 'meters': None, 'seconds': None, 'polyline': None}
+
+
+def duration_text(seconds):
+    """Duration written the way Google writes it, e.g. '1 hour 5 mins'."""
+    hours, minutes = divmod(max(1, int(round(seconds / 60))), 60)
+    parts = []
+    if hours:
+        parts.append(f"{hours} hour{'s' if hours != 1 else ''}")
+    if minutes or not hours:
+        parts.append(f"{minutes} min{'s' if minutes != 1 else ''}")
+    return ' '.join(parts)
+
+
+def estimate_legs(pairs, coords):
+    """
+    Estimated legs for (origin, destination) pairs, from the great-circle distance
+    between coords[origin] and coords[destination] (gmaps_id -> (lat, lng)),
+    computed for every pair in one pass. Estimated legs have no polyline and carry
+    'estimated': True; pairs without coordinates come back as failed legs.
+    """
+    legs = [failed_leg() for _ in pairs]
+    known = [i for i, (o, d) in enumerate(pairs) if coords.get(o) is not None and coords.get(d) is not None]
+    if not known:
+        return legs
+
+    origins = np.array([coords[pairs[i][0]] for i in known], dtype=float)
+    destinations = np.array([coords[pairs[i][1]] for i in known], dtype=float)
+    km = haversine_km(origins, destinations)
+    seconds = estimated_seconds(km)
+    for i, road_km, secs in zip(known, km * DETOUR_FACTOR, seconds):
+        legs[i] = {
+            'distance': f'~{road_km:.0f} km',
+            'duration': f'~{duration_text(secs)}',
+            'meters': int(road_km * 1000),
+            'seconds': int(secs),
+            'polyline': None,
+            'estimated': True,
+        }
+    return legs
+
+
+LEG_WORKERS = int(os.environ.get('LEG_WORKERS', 8))
+
+# With ROUTING_OFFLINE=1 Google is never asked for legs; uncached legs are estimated
+ROUTING_OFFLINE = os.environ.get('ROUTING_OFFLINE', '').lower() in ('1', 'true', 'on')
+
+
+class RequestBudget:
+    """
+    Daily allowance (UTC days) of Google Maps requests made by this process for
+    legs; 0 means unlimited. Each worker process has its own allowance.
+    """
+
+    def __init__(self, per_day):
+        self.per_day = per_day
+        self._day = None
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def take(self, count):
+        """Reserve count requests. Returns False, reserving nothing, if that would exceed the allowance."""
+        if not self.per_day:
+            return True
+        today = time.gmtime()[:3]
+        with self._lock:
+            if today != self._day:
+                self._day, self._used = today, 0
+            if self._used + count > self.per_day:
+                return False
+            self._used += count
+            return True
+
+
+gmaps_budget = RequestBudget(int(os.environ.get('GMAPS_DAILY_BUDGET', 0)))
+
+
+def leg_pairs(gmaps_ids):
+    """
+    Consecutive (origin, destination) pairs for the driving route,
+    including the closing leg from the last stop back to the first.
+    """
+    n = len(gmaps_ids)
+    return [(gmaps_ids[i], gmaps_ids[(i + 1) % n]) for i in range(n)]
+
+
+def resolve_legs(pairs, mode='driving', client=None, max_workers=LEG_WORKERS, coords=None, offline=None):
+    """
+    Resolve every (origin, destination) pair to a leg dict in as few round trips as possible.
+
+    Cached legs are returned without touching the network. The rest come from
+    one Directions request each (see fetch_leg), issued concurrently through a
+    bounded thread pool, so wall time follows the slowest request rather than
+    the sum of them.
+
+    Legs Google could not route are estimated from coords (gmaps_id -> (lat, lng))
+    with estimate_legs, as is every uncached leg when offline (ROUTING_OFFLINE
+    unless given) or once gmaps_budget is spent. Estimates are never cached.
+    Estimates standing in for an answer Google never gave (it was unreachable or
+    the budget was spent) also carry 'pending': True, since a later try can do better.
+    """
+    offline = ROUTING_OFFLINE if offline is None else offline
+    legs = [leg_cache.get(o, d, mode) for o, d in pairs]
+
+    # Each distinct missing pair is only fetched once
+    missing = list(dict.fromkeys(pair for pair, leg in zip(pairs, legs) if leg is None))
+    if missing and not offline and gmaps_budget.take(len(missing)):
+        try:
+            legs = fetch_missing_legs(pairs, legs, missing, mode, client, max_workers)
+        except (googlemaps.exceptions.ApiError, googlemaps.exceptions.TransportError,
+                googlemaps.exceptions.Timeout) as e:
+            logger.warning("Google routing unavailable, estimating %d legs: %s", len(missing), e)
+
+    unrouted = [i for i, leg in enumerate(legs) if leg is None or leg.get('seconds') is None]
+    if unrouted:
+        for i, leg in zip(unrouted, estimate_legs([pairs[i] for i in unrouted], coords or {})):
+            # A route Google did find is still drawn, even without a distance/duration
+            pending = legs[i] is None and not offline
+            legs[i] = dict(leg, polyline=(legs[i] or {}).get('polyline'), pending=pending)
+    return legs
+
+
+def fetch_missing_legs(pairs, legs, missing, mode, client, max_workers):
+    """Fetch the missing pairs from Google (see resolve_legs), cache them and fill them into legs."""
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        jobs = [pool.submit(bind_route(fetch_leg), o, d, mode, client) for o, d in missing]
+        fetched = {pair: job.result() for pair, job in zip(missing, jobs)}
+
+    for (o, d), leg in fetched.items():
+        leg_cache.put(o, d, mode, leg)
+
+    return [leg if leg is not None else dict(fetched[pair]) for pair, leg in zip(pairs, legs)]
 
 
     
     
-def plot_drives(m, stops, gmaps_ids, coords):
-    for i in range(len(stops.places.values())):
-        if i + 1 < len(stops.places.keys()):
-            distance, duration, decoded_route = get_distance(gmaps_ids, i)
-            if decoded_route == 'failed':
-                add_route_segment(m, [coords[i], coords[i+1]], distance, duration)
-            else:
-                add_route_segment(m, decoded_route, distance, duration)
-            
+def driving_rows(rows):
+    return [row for row in rows if row.get('drive') == 'y']
+
+
+def stored_leg_set(rows):
+    """
+    Every usable leg saved on the stop documents, keyed by its (origin, destination)
+    gmaps_id pair. A leg is usable when it records both ends and has a route.
+    """
+    legs = {}
+    for row in rows:
+        leg = row.get('leg')
+        if isinstance(leg, dict) and leg.get('polyline') and leg.get('origin') and leg.get('destination'):
+            legs[(leg['origin'], leg['destination'])] = leg
+    return legs
+
+
+def stored_legs(rows):
+    """
+    Legs of the current driving route, in route order, taken from the legs saved
+    on the stops (see stored_leg_set). Legs are matched by the pair of places they
+    join, not by which stop holds them, so after an insert, delete or move only
+    the pairs that didn't exist before come back as None.
+    """
+    known = stored_leg_set(rows)
+    pairs = leg_pairs([row.get('gmaps_id') for row in driving_rows(rows)])
+    return [known.get(pair) for pair in pairs]
+
+
+def route_legs(gmaps_ids, legs=None, coords=None, offline=None):
+    """
+    Legs of the driving route in order, starting from any stored legs
+    (see stored_legs) and resolving only the ones that are missing. coords are
+    the driving stops' (lat, lng), used to estimate legs that can't be fetched.
+    """
+    pairs = leg_pairs(gmaps_ids)
+    if legs is None or len(legs) != len(pairs):
+        legs = [None] * len(pairs)
+    legs = list(legs)
+
+    # Only legs without a usable stored copy go to the cache/Google
+    missing = [i for i, leg in enumerate(legs) if leg is None]
+    if missing:
+        points = dict(zip(gmaps_ids, coords)) if coords is not None else None
+        for i, leg in zip(missing, resolve_legs([pairs[i] for i in missing], coords=points, offline=offline)):
+            legs[i] = leg
+    return legs
+
+
+def plot_drives(m, stops, gmaps_ids, legs=None, offline=None):
+    # Legs join consecutive driving stops, so fallback lines use their coordinates
+    coords = stops.get_all_coords()
+    legs = route_legs(gmaps_ids, legs, coords, offline)
+
+    for i, leg in enumerate(legs):
+        if leg['polyline']:
+            # folium can only draw one level of detail, so use the finest one
+            decoded_route = simplify(polyline.decode(leg['polyline']), FINE_TOLERANCE).tolist()
         else:
-            distance, duration, decoded_route = get_distance(gmaps_ids, 'final')
-            if decoded_route == 'failed':
-                add_route_segment(m, [coords[i], coords[i+1]], distance, duration)
-            else:
-                add_route_segment(m, decoded_route, distance, duration)
-        
-    return
+            decoded_route = [coords[i], coords[(i + 1) % len(coords)]]
+        add_route_segment(m, decoded_route, leg['distance'], leg['duration'],
+                          estimated=leg.get('estimated', False), routed=bool(leg['polyline']))
+
+    return legs
     
     
     
@@ -3,14 +3,31 @@ import os
 import io
 import json
 import base64
+import gzip
 import datetime
+import hashlib
+import hmac
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 import csv
 
+import numpy as np
+
 from Utility.plotting_functions import *
 from Utility.html_edits import *
 from Utility.classes import Place, RoadTrip
 from Utility.utility_functions import *
+from Utility.caches import geocode_cache, leg_cache, render_cache, acl_cache
+from Utility.artifacts import map_artifacts
+from Utility.bundle import VendoredAssets, build_bundle, gzip_bundle, zip_bundle
+from Utility.importer import geocode_places, import_places, spool_csv_upload
+from Utility.ordering import SEQ_GAP, desired_order, plan_reorder
+from Utility.geometry import haversine_matrix, estimated_seconds
+from Utility.routing import optimize_order, route_cost
+from Utility.jobs import MapDeletionJobs, MapImportJobs, MapRenderJobs
+from Utility import metrics
 
 from dotenv import load_dotenv
 from flask import (
@@ -24,8 +41,7 @@ from firebase_admin import credentials, auth as fb_auth, firestore as fb_firesto
 
 from werkzeug.utils import secure_filename
 
-from make_map import generate_map
-import tempfile
+from make_map import generate_map, map_content_hash
 
 
 env_path = '/home/sbarnett/roadtrip_planner/.env'
@@ -68,6 +84,21 @@ def create_app():
             raise RuntimeError(f"CRITICAL: Service account file not found at {cred_path}")
 
     init_firebase()
+    metrics.instrument_firestore()
+
+    # Subcollections of deleted maps are removed in the background
+    app.deletion_jobs = MapDeletionJobs(app.db) if app.db is not None else None
+
+    def resume_deletions():
+        try:
+            resumed = app.deletion_jobs.resume_pending()
+            if resumed:
+                app.logger.info("Resumed %d map deletion job(s)", resumed)
+        except Exception as e:
+            app.logger.exception("Could not resume map deletion jobs: %s", e)
+
+    if app.deletion_jobs is not None:
+        threading.Thread(target=resume_deletions, daemon=True).start()
 
 
     # -------------------------
@@ -84,31 +115,187 @@ def create_app():
     @app.before_request
     def load_user():
         g.uid = session.get('uid')
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_time(response):
+        started = g.get('request_started')
+        if started is not None:
+            metrics.http_request_seconds.observe(
+                time.perf_counter() - started,
+                route=request.endpoint or 'unknown', method=request.method, status=response.status_code
+            )
+        return response
+
+
+    def reserve_sequence_numbers(uid, map_id, count=1):
+        """
+        Atomically reserve `count` consecutive stop ids from the map's last_seq
+        counter and return the first of them. Maps whose counter was never used
+        (last_seq == 0) are seeded from their highest existing stop id.
+        """
+        db = app.db
+        map_ref = db.collection("users").document(uid).collection("maps").document(map_id)
+
+        @fb_firestore.transactional
+        def reserve(transaction):
+            snap = map_ref.get(transaction=transaction)
+            last_seq = (snap.to_dict() or {}).get("last_seq") or 0
+
+            if not last_seq:
+                query = map_ref.collection("stops").order_by("id", direction=fb_firestore.Query.DESCENDING).limit(1)
+                docs = list(query.stream(transaction=transaction))
+                if docs:
+                    last_seq = docs[0].to_dict().get("id", 0) or 0
+
+            transaction.update(map_ref, {"last_seq": last_seq + count})
+            return last_seq + 1
+
+        with metrics.firestore_timer('transaction', 'write', 1):
+            return reserve(db.transaction())
+
+
+    def raise_sequence_floor(uid, map_id, value):
+        """Make sure the map's last_seq counter is at least value, so reserved ids don't collide."""
+        db = app.db
+        map_ref = db.collection("users").document(uid).collection("maps").document(map_id)
+
+        @fb_firestore.transactional
+        def raise_floor(transaction):
+            snap = map_ref.get(transaction=transaction)
+            if ((snap.to_dict() or {}).get("last_seq") or 0) < value:
+                transaction.update(map_ref, {"last_seq": value})
+
+        with metrics.firestore_timer('transaction', 'write', 1):
+            raise_floor(db.transaction())
+
+
+    # Firestore rejects batches of more than 500 writes
+    BATCH_LIMIT = 450
+
+    def commit_writes(writes):
+        """
+        Apply a list of (op, doc_ref, data) writes, where op is 'set', 'update' or
+        'delete', using as few batches as possible. Returns the number of writes.
+        """
+        db = app.db
+        for start in range(0, len(writes), BATCH_LIMIT):
+            batch = db.batch()
+            chunk = writes[start:start + BATCH_LIMIT]
+            for op, doc_ref, data in chunk:
+                if op == 'set':
+                    batch.set(doc_ref, data)
+                elif op == 'update':
+                    batch.update(doc_ref, data)
+                else:
+                    batch.delete(doc_ref)
+            with metrics.firestore_timer('commit', 'write', len(chunk)):
+                batch.commit()
+        return len(writes)
+
+
+    def commit_updates(updates):
+        """Apply a list of (doc_ref, fields) updates in as few batches as possible."""
+        return commit_writes([('update', doc_ref, fields) for doc_ref, fields in updates])
+
+
+    # Tombstones of deleted stops are kept this long: their expire_at field has a
+    # TTL policy (firestore.indexes.json), and a /api/stops?since= cursor older
+    # than this gets a full resync instead of a delta
+    TOMBSTONE_RETENTION = datetime.timedelta(days=int(os.environ.get('TOMBSTONE_RETENTION_DAYS', 30)))
 
+    # Stop writes that always fit in one commit_stop_writes() batch, even if all are deletes
+    STOP_WRITES_PER_BATCH = (BATCH_LIMIT - 1) // 2
 
-    def get_next_sequence_number(uid, map_id):
+    def commit_stop_writes(owner_id, map_id, writes):
+        """
+        commit_writes() for writes to a map's stops, keeping what /api/stops?since=
+        relies on: every written stop gets an updated_at server timestamp, every
+        deleted stop leaves a tombstone in 'deleted_stops' (expiring after
+        TOMBSTONE_RETENTION) and the map's version counter is incremented. A
+        delete and its tombstone always share a batch, and every batch bumps the
+        version, so a batch that fails leaves neither half behind.
+        """
+        map_ref = app.db.collection("users").document(owner_id).collection("maps").document(map_id)
+        tombstones = map_ref.collection("deleted_stops")
+        expire_at = datetime.datetime.now(datetime.timezone.utc) + TOMBSTONE_RETENTION
+        bump = ('update', map_ref, {"version": fb_firestore.Increment(1)})
+
+        batches = [[]]
+        for op, doc_ref, data in writes:
+            if op == 'delete':
+                group = [(op, doc_ref, data),
+                         ('set', tombstones.document(doc_ref.id),
+                          {"deleted_at": fb_firestore.SERVER_TIMESTAMP, "expire_at": expire_at})]
+            else:
+                group = [(op, doc_ref, dict(data, updated_at=fb_firestore.SERVER_TIMESTAMP))]
+            if len(batches[-1]) + len(group) >= BATCH_LIMIT:
+                batches.append([])
+            batches[-1].extend(group)
+
+        for batch in batches:
+            commit_writes(batch + [bump])
+        return sum(len(batch) + 1 for batch in batches)
+
+
+    def refresh_map_legs(owner_id, map_id):
+        """
+        Bring the legs stored on users/{owner_id}/maps/{map_id}/stops up to date.
+        Each driving stop keeps the leg to the next driving stop (the last one loops
+        back to the first). Legs are identified by the pair of places they join, so
+        the current route is diffed against every leg already stored: only pairs no
+        stop has a leg for are looked up, only stops whose leg changed are written,
+        and legs left on stops that no longer drive are removed.
+        """
         db = app.db
-        stops_ref = (
-            db.collection("users")
-            .document(uid)
-            .collection("maps")
-            .document(map_id)
-            .collection("stops")
-        )
+        stops_ref = db.collection("users").document(owner_id).collection("maps").document(map_id).collection("stops")
+        docs = list(stops_ref.order_by("id").stream())
+        rows = [d.to_dict() or {} for d in docs]
+
+        drives = [(d, row) for d, row in zip(docs, rows) if row.get('drive') == 'y']
+        pairs = leg_pairs([row.get('gmaps_id') for _, row in drives])
+        legs = stored_legs(rows)
 
-        # Get the highest seq value
-        query = stops_ref.order_by("id", direction=fb_firestore.Query.DESCENDING).limit(1)
-        docs = list(query.stream())
+        missing = [i for i, leg in enumerate(legs) if leg is None]
+        if missing:
+            for i, leg in zip(missing, resolve_legs([pairs[i] for i in missing])):
+                # Only real routes are worth keeping; the rest are tried again next time
+                if leg.get('polyline') and not leg.get('estimated'):
+                    origin_id, destination_id = pairs[i]
+                    legs[i] = dict(leg, origin=origin_id, destination=destination_id)
 
-        if not docs:
-            return 1  # first stop
+        updates = []
+        for (d, row), pair, leg in zip(drives, pairs, legs):
+            held = row.get('leg') if isinstance(row.get('leg'), dict) else {}
+            if leg is not None and ((held.get('origin'), held.get('destination')) != pair or not held.get('polyline')):
+                updates.append((d.reference, {"leg": leg}))
 
-        highest_seq = docs[0].to_dict().get("id", 0)
-        return highest_seq + 1
+        for d, row in zip(docs, rows):
+            if row.get('drive') != 'y' and 'leg' in row:
+                updates.append((d.reference, {"leg": fb_firestore.DELETE_FIELD}))
+
+        return commit_updates(updates)
+
+
+    def stops_changed(owner_id, map_id, refresh_legs=True):
+        """
+        Called after any write to a map's stops. The map is re-rendered in the
+        background (see prerender_map), after refreshing its stored legs when the
+        write touched the route.
+        """
+        render_cache.invalidate(owner_id, map_id)
+        app.render_jobs.enqueue(owner_id, map_id, refresh_legs=refresh_legs)
 
 
 
 
+    def invalidate_map_access(owner_uid, map_id):
+        acl_cache.invalidate(owner_uid, map_id)
+        memo = g.get('acl_memo')
+        if memo is not None:
+            memo.pop((owner_uid, map_id), None)
+
+
     # -------------------------
     # Collaboration helpers + routes
     # -------------------------
@@ -135,6 +322,7 @@ def create_app():
                 },
                 "collaborator_uids": fb_firestore.ArrayUnion([collaborator_uid])
             })
+            invalidate_map_access(owner_uid, map_id)
 
 
     @app.route('/collaborate', methods=['GET', 'POST'])
@@ -259,6 +447,7 @@ def create_app():
                 f"collaborators.{collab_uid}": fb_firestore.DELETE_FIELD,
                 "collaborator_uids": fb_firestore.ArrayRemove([collab_uid])
             })
+            invalidate_map_access(uid, map_id)
 
             if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
                 return jsonify({'status': 'ok', 'removed': collab_uid}), 200
@@ -309,13 +498,87 @@ def create_app():
              .collection("stops") \
              .document(place.name)
 
-        place.id = get_next_sequence_number(uid, map_id)
-        doc_ref.set(place.to_dict())
+        place.id = reserve_sequence_numbers(uid, map_id)
+        commit_stop_writes(uid, map_id, [('set', doc_ref, place.to_dict())])
+        stops_changed(uid, map_id)
         return doc_ref.id
 
 
 
 
+    # Per-row errors kept on the map document after an import
+    MAX_IMPORT_ERRORS = 100
+
+    # Largest CSV upload accepted for import
+    MAX_IMPORT_BYTES = 900 * 1024
+
+    # A running import refreshes its status's heartbeat_at at least this often;
+    # one queued or running that hasn't for IMPORT_STALE_SECONDS is reported as
+    # failed (its worker died or restarted)
+    IMPORT_HEARTBEAT_SECONDS = 15
+    IMPORT_STALE_SECONDS = int(os.environ.get('IMPORT_STALE_SECONDS', 600))
+
+    def import_status(state, **fields):
+        return dict({"state": state, "total": 0, "imported": 0, "errors": [],
+                     "heartbeat_at": datetime.datetime.now(datetime.timezone.utc)}, **fields)
+
+    def import_csv_into_map(uid, map_id, csv_path, encoding):
+        """
+        Import the stops in the CSV file at csv_path into users/{uid}/maps/{map_id},
+        then remove the file. Rows are read as a stream and geocoded concurrently
+        (see Utility.importer) and written with batched writes, with progress
+        recorded in the map's 'import' field. Runs on app.import_jobs; a failure
+        is recorded as state 'failed'. Returns the final import status dict.
+        """
+        map_ref = app.db.collection("users").document(uid).collection("maps").document(map_id)
+        try:
+            return run_csv_import(uid, map_id, map_ref, csv_path, encoding)
+        except Exception as e:
+            map_ref.update({"import.state": "failed", "import.error": str(e)})
+            raise
+        finally:
+            os.remove(csv_path)
+
+    def run_csv_import(uid, map_id, map_ref, csv_path, encoding):
+        """The import itself (see import_csv_into_map)."""
+        stops_ref = map_ref.collection("stops")
+        last_beat = [time.monotonic()]
+
+        def heartbeat(geocoded):
+            if time.monotonic() - last_beat[0] >= IMPORT_HEARTBEAT_SECONDS:
+                last_beat[0] = time.monotonic()
+                map_ref.update({"import.heartbeat_at": datetime.datetime.now(datetime.timezone.utc),
+                                "import.geocoded": geocoded})
+
+        map_ref.update({"import": import_status("geocoding")})
+        with open(csv_path, encoding=encoding, newline='') as f:
+            places, errors = import_places(f, progress=heartbeat)
+        status = import_status("writing", total=len(places) + len(errors), errors=errors[:MAX_IMPORT_ERRORS])
+        map_ref.update({"import": status})
+
+        if places:
+            first_id = reserve_sequence_numbers(uid, map_id, count=len(places))
+            for offset, place in enumerate(places):
+                place.id = first_id + offset
+
+            for start in range(0, len(places), BATCH_LIMIT):
+                chunk = places[start:start + BATCH_LIMIT]
+                commit_stop_writes(uid, map_id, [('set', stops_ref.document(place.name), place.to_dict()) for place in chunk])
+                status["imported"] += len(chunk)
+                map_ref.update({"import.imported": status["imported"],
+                                "import.heartbeat_at": datetime.datetime.now(datetime.timezone.utc)})
+
+        status["state"] = "done"
+        map_ref.update({"import": status})
+        if places:
+            stops_changed(uid, map_id)
+        return status
+
+    app.import_jobs = MapImportJobs(import_csv_into_map)
+
+
+
+
     # -------------------------
     # Routes
     # -------------------------
@@ -377,44 +640,88 @@ def create_app():
 
 
 
+    def map_access_roles(owner_uid, map_doc):
+        """{uid: role} of everyone who may open the map: the owner plus its collaborators."""
+        roles = {owner_uid: 'owner'}
+        for uid, entry in ((map_doc.to_dict() or {}).get('collaborators') or {}).items():
+            if entry:
+                roles[uid] = entry.get('role', 'editor')
+        return roles
+
     # helper: check whether user_uid has access to owner_uid's map
     def check_map_access(owner_uid, map_id, user_uid, require_write=False):
         """
         Return (True, map_doc) if user_uid is allowed to access map at users/{owner_uid}/maps/{map_id}.
         If require_write=True then collaborator must have role 'editor' (or be owner).
         Otherwise 'viewer' or 'editor' suffices for read access.
+
+        Only the decision is cached (see AclCache): map_doc is the snapshot read
+        during this request, or None when the access list came from the cache,
+        so read the map afresh for anything besides access.
         """
         db = getattr(app, 'db', None)
         if db is None:
             return False, None
 
-        map_ref = db.collection("users").document(owner_uid).collection("maps").document(map_id)
-        try:
-            map_doc = map_ref.get()
-        except Exception as e:
-            app.logger.exception("check_map_access: failed to read map: %s", e)
-            return False, None
-
-        if not map_doc.exists:
+        # Memoised for the rest of this request, and cached briefly across requests
+        memo = g.setdefault('acl_memo', {})
+        entry = memo.get((owner_uid, map_id))
+        if entry is not None:
+            acl_cache.count_request_hit()
+            roles, map_doc = entry
+        else:
+            map_doc = None
+            roles = acl_cache.get(owner_uid, map_id)
+            if roles is None:
+                map_ref = db.collection("users").document(owner_uid).collection("maps").document(map_id)
+                try:
+                    map_doc = map_ref.get()
+                except Exception as e:
+                    app.logger.exception("check_map_access: failed to read map: %s", e)
+                    return False, None
+                roles = map_access_roles(owner_uid, map_doc) if map_doc.exists else {}
+                if roles:
+                    acl_cache.put(owner_uid, map_id, roles)
+            memo[(owner_uid, map_id)] = (roles, map_doc)
+
+        # no access list means the map doesn't exist
+        if not roles:
             return False, None
 
-        if user_uid == owner_uid:
-            return True, map_doc
-
-        data = map_doc.to_dict() or {}
-        collab_map = data.get('collaborators') or {}
-        entry = collab_map.get(user_uid)
-        if not entry:
+        role = roles.get(user_uid)
+        if role is None:
             return False, map_doc
-
-        role = entry.get('role', 'editor')
-        if require_write and role != 'editor':
+        if require_write and role not in ('owner', 'editor'):
             return False, map_doc
 
-        # read allowed (role present), or write allowed (role == editor)
+        # read allowed (role present), or write allowed (owner or editor)
         return True, map_doc
 
 
+    # Stop fields that change which legs make up the driving route
+    ROUTE_FIELDS = {'id', 'drive', 'gmaps_id'}
+
+    def coerce_stop_value(field, value):
+        """Attempt to coerce certain types (basic heuristics)."""
+        new_value = value
+        if field == 'id':
+            try:
+                new_value = int(value)
+            except Exception:
+                pass
+        else:
+            if isinstance(value, str):
+                if value.isdigit():
+                    new_value = int(value)
+                else:
+                    try:
+                        fv = float(value)
+                        if '.' in value:
+                            new_value = fv
+                    except Exception:
+                        pass
+        return new_value
+
     @app.route('/api/stops/update', methods=['POST'])
     @login_required
     def api_update_stop_field():
@@ -439,33 +746,174 @@ def create_app():
             return jsonify({'error': 'access denied'}), 403
 
         try:
-            # Attempt to coerce certain types (basic heuristics)
-            new_value = value
-            if field == 'id':
-                try:
-                    new_value = int(value)
-                except Exception:
-                    pass
-            else:
-                if isinstance(value, str):
-                    if value.isdigit():
-                        new_value = int(value)
-                    else:
-                        try:
-                            fv = float(value)
-                            if '.' in value:
-                                new_value = fv
-                        except Exception:
-                            pass
+            new_value = coerce_stop_value(field, value)
 
             doc_ref = db.collection("users").document(owner_id).collection("maps").document(map_id).collection("stops").document(doc_id)
-            doc_ref.update({field: new_value})
+            commit_stop_writes(owner_id, map_id, [('update', doc_ref, {field: new_value})])
+            stops_changed(owner_id, map_id, refresh_legs=field in ROUTE_FIELDS)
             return jsonify({'status': 'ok'}), 200
         except Exception as e:
             app.logger.exception("api_update_stop_field error: %s", e)
             return jsonify({'error': 'failed to update field'}), 500
 
 
+    # Upper bound on operations accepted by one /api/stops/batch call
+    MAX_BATCH_OPS = 2000
+
+    @app.route('/api/stops/batch', methods=['POST'])
+    @login_required
+    def api_batch_stops():
+        """
+        Apply many stop edits with one permission check and as few commits as possible.
+        Expects JSON: { "map_id": "...", "owner_id": "..." (optional), "ops": [...] } where each op is
+          { "op": "update", "doc_id": "...", "field": "...", "value": ... }
+          { "op": "update", "doc_id": "...", "fields": { field: value, ... } }
+          { "op": "delete", "doc_id": "..." }
+          { "op": "insert", "stop": { "name": "...", "desc": "...", ... } }
+        Updates to the same stop are merged into one write. Returns a result per op.
+        """
+        uid = session.get('uid')
+        payload = request.get_json(silent=True) or {}
+        map_id = payload.get('map_id') or session.get('current_map_id')
+        owner_id = payload.get('owner_id') or uid
+        ops = payload.get('ops')
+
+        if not map_id or not isinstance(ops, list):
+            return jsonify({'error': 'missing parameters'}), 400
+        if len(ops) > MAX_BATCH_OPS:
+            return jsonify({'error': f'too many operations (max {MAX_BATCH_OPS})'}), 400
+
+        db = getattr(app, 'db', None)
+        if db is None:
+            return jsonify({'error': 'firestore not configured'}), 500
+
+        allowed, map_doc = check_map_access(owner_id, map_id, uid, require_write=True)
+        if not allowed:
+            return jsonify({'error': 'access denied'}), 403
+
+        stops_ref = db.collection("users").document(owner_id).collection("maps").document(map_id).collection("stops")
+        results = [None] * len(ops)
+        updates = {}   # doc_id -> merged fields
+        owners = {}    # doc_id -> indexes of the ops merged into its write
+        deletes = {}   # doc_id -> indexes of the ops deleting it
+        inserts = []
+        route_changed = False
+
+        for i, op in enumerate(ops):
+            kind = op.get('op') if isinstance(op, dict) else None
+            doc_id = op.get('doc_id') if isinstance(op, dict) else None
+
+            if kind == 'update':
+                fields = op.get('fields') if isinstance(op.get('fields'), dict) else {op.get('field'): op.get('value')}
+                if not doc_id or None in fields or not fields:
+                    results[i] = {'status': 'error', 'error': 'missing doc_id or field'}
+                    continue
+                merged = updates.setdefault(doc_id, {})
+                for field, value in fields.items():
+                    merged[field] = coerce_stop_value(field, value)
+                owners.setdefault(doc_id, []).append(i)
+                route_changed = route_changed or bool(ROUTE_FIELDS & set(fields))
+
+            elif kind == 'delete':
+                if not doc_id:
+                    results[i] = {'status': 'error', 'error': 'missing doc_id'}
+                    continue
+                deletes.setdefault(doc_id, []).append(i)
+                route_changed = True
+
+            elif kind == 'insert':
+                stop = op.get('stop') or {}
+                name = (stop.get('name') or '').strip()
+                if not name or '/' in name:
+                    results[i] = {'status': 'error', 'error': 'invalid name'}
+                    continue
+                place = Place(None, name, stop.get('desc', ''), stop.get('colour', 'blue'), stop.get('drive', 'n'),
+                              stop.get('place_type', 'poi'), stop.get('nickname') or name)
+                if stop.get('gmaps_id') and stop.get('lat') is not None and stop.get('lng') is not None:
+                    place.add_geo_data(stop['gmaps_id'], stop['lat'], stop['lng'])
+                inserts.append((i, place))
+
+            else:
+                results[i] = {'status': 'error', 'error': 'unknown op'}
+
+        # Inserts without coordinates are geocoded together, a bounded number at a time
+        if inserts:
+            try:
+                errors = geocode_places([place for _, place in inserts])
+            except Exception as e:
+                app.logger.exception("api_batch_stops geocoding failed: %s", e)
+                errors = ['geocoding failed'] * len(inserts)
+            geocoded = []
+            for (i, place), error in zip(inserts, errors):
+                if error is not None:
+                    results[i] = {'status': 'error', 'error': str(error)}
+                else:
+                    geocoded.append((i, place))
+            inserts = geocoded
+            route_changed = route_changed or bool(inserts)
+
+        # A delete wins over updates to the same stop
+        for doc_id in deletes:
+            for i in owners.pop(doc_id, []):
+                results[i] = {'status': 'ok', 'doc_id': doc_id, 'note': 'superseded by delete'}
+            updates.pop(doc_id, None)
+
+        # One read for all touched stops, so a missing stop fails its own ops rather than the whole commit
+        if updates:
+            refs = [stops_ref.document(doc_id) for doc_id in updates]
+            try:
+                snaps = list(db.get_all(refs, field_paths=['id']))
+            except Exception as e:
+                app.logger.exception("api_batch_stops read failed: %s", e)
+                for doc_id in updates:
+                    for i in owners.pop(doc_id):
+                        results[i] = {'status': 'error', 'error': 'read failed', 'doc_id': doc_id}
+                updates, snaps = {}, []
+            for snap in snaps:
+                if not snap.exists:
+                    for i in owners.pop(snap.id, []):
+                        results[i] = {'status': 'error', 'error': 'stop not found', 'doc_id': snap.id}
+                    updates.pop(snap.id, None)
+
+        if inserts:
+            try:
+                first_id = reserve_sequence_numbers(owner_id, map_id, count=len(inserts))
+            except Exception as e:
+                app.logger.exception("api_batch_stops could not reserve stop ids: %s", e)
+                for i, place in inserts:
+                    results[i] = {'status': 'error', 'error': 'could not reserve stop ids', 'doc_id': place.name}
+                inserts = []
+            for offset, (_, place) in enumerate(inserts):
+                place.id = first_id + offset
+
+        writes = [('update', stops_ref.document(doc_id), fields) for doc_id, fields in updates.items()]
+        writes += [('delete', stops_ref.document(doc_id), None) for doc_id in deletes]
+        writes += [('set', stops_ref.document(place.name), place.to_dict()) for _, place in inserts]
+        indexes = [owners[doc_id] for doc_id in updates]
+        indexes += list(deletes.values())
+        indexes += [[i] for i, _ in inserts]
+
+        committed = False
+        for start in range(0, len(writes), STOP_WRITES_PER_BATCH):
+            try:
+                commit_stop_writes(owner_id, map_id, writes[start:start + STOP_WRITES_PER_BATCH])
+                outcome = {'status': 'ok'}
+                committed = True
+            except Exception as e:
+                app.logger.exception("api_batch_stops commit failed: %s", e)
+                outcome = {'status': 'error', 'error': 'commit failed'}
+            for (_, doc_ref, _), op_indexes in zip(writes[start:start + STOP_WRITES_PER_BATCH],
+                                                   indexes[start:start + STOP_WRITES_PER_BATCH]):
+                for i in op_indexes:
+                    results[i] = dict(outcome, doc_id=doc_ref.id)
+
+        if committed:
+            stops_changed(owner_id, map_id, refresh_legs=route_changed)
+
+        failed = sum(1 for r in results if r['status'] != 'ok')
+        return jsonify({'status': 'ok' if not failed else 'partial', 'results': results}), 200
+
+
     @app.route('/api/stops/delete', methods=['POST'])
     @login_required
     def api_delete_stop():
@@ -494,11 +942,12 @@ def create_app():
 
         try:
             # Delete the specific document
-            db.collection("users").document(owner_id)\
+            doc_ref = db.collection("users").document(owner_id)\
               .collection("maps").document(map_id)\
-              .collection("stops").document(doc_id)\
-              .delete()
+              .collection("stops").document(doc_id)
+            commit_stop_writes(owner_id, map_id, [('delete', doc_ref, None)])
 
+            stops_changed(owner_id, map_id)
             return jsonify({'status': 'ok', 'deleted': doc_id}), 200
         except Exception as e:
             app.logger.exception("Failed to delete stop %s", doc_id)
@@ -514,15 +963,38 @@ def create_app():
         Query params:
           - map_id (required)
           - owner_id (optional) -> when absent, defaults to session['uid']
+          - since (optional) -> the 'cursor' of an earlier response; only stops changed
+            after it are returned, plus the doc ids of stops deleted since ('deleted').
+            A cursor older than TOMBSTONE_RETENTION gets every stop with 'resync': true.
+        Responses carry an ETag naming the map's current state (the same with or without since);
+        a matching If-None-Match gets a 304 without reading any stops.
         Access: owner or collaborator (viewer/editor) for read.
         """
         uid = session.get('uid')
         map_id = request.args.get('map_id') or session.get('current_map_id')
         owner_id = request.args.get('owner_id') or uid  # allow owner override for shared maps
+        since = request.args.get('since')
 
         if not map_id:
             return jsonify({"error": "missing map_id"}), 400
 
+        since_dt = None
+        if since:
+            try:
+                # a '+' in an unencoded UTC offset arrives as a space
+                since_dt = datetime.datetime.fromisoformat(since.replace(' ', '+'))
+            except ValueError:
+                return jsonify({"error": "invalid since cursor"}), 400
+            if since_dt.tzinfo is None:
+                since_dt = since_dt.replace(tzinfo=datetime.timezone.utc)
+
+        # Tombstones older than the retention window may be gone, so deletions
+        # since an older cursor can't be listed: send everything instead
+        now = datetime.datetime.now(datetime.timezone.utc)
+        resync = since_dt is not None and since_dt < now - TOMBSTONE_RETENTION
+        if resync:
+            since_dt = None
+
         db = getattr(app, 'db', None)
         if db is None:
             return jsonify({"error": "firestore not configured"}), 500
@@ -533,21 +1005,68 @@ def create_app():
             return jsonify({"error": "access denied"}), 403
 
         try:
-            coll = db.collection("users").document(owner_id).collection("maps").document(map_id).collection("stops")
-            try:
-                docs = coll.order_by("id").stream()
-            except Exception:
-                docs = coll.stream()
+            map_ref = db.collection("users").document(owner_id).collection("maps").document(map_id)
+            # read fresh: every stop write bumps the map's version (and so its update_time)
+            map_snap = map_ref.get()
+            map_meta = map_snap.to_dict() or {}
+            version = map_meta.get("version", 0)
+
+            # Names the map's state, not the response: a client that saw it, in full
+            # or as a delta, has nothing new to fetch whatever cursor it sends
+            etag = hashlib.sha256(f"{owner_id}/{map_id}/{map_snap.update_time}".encode()).hexdigest()[:32]
+            if etag in request.if_none_match:
+                resp = Response(status=304)
+                resp.set_etag(etag)
+                return resp
+
+            coll = map_ref.collection("stops")
+            if since_dt is not None:
+                docs = coll.where("updated_at", ">", since_dt).stream()
+            else:
+                try:
+                    docs = coll.order_by("id").stream()
+                except Exception:
+                    docs = coll.stream()
 
             stops = []
+            cursor = since_dt
             for d in docs:
                 data = d.to_dict() or {}
                 data['_doc_id'] = d.id
+                # leg geometry is only needed for rendering the map
+                data.pop('leg', None)
+                updated = data.get('updated_at')
+                if updated is not None and (cursor is None or updated > cursor):
+                    cursor = updated
                 stops.append(data)
 
-            # optionally include map metadata (owner, name, visible_fields)
-            map_meta = (map_doc.to_dict() or {}) if map_doc else {}
-            return jsonify({"stops": stops, "map_meta": map_meta}), 200
+            if since_dt is None:
+                body = {"stops": stops, "map_meta": map_meta}
+                if resync:
+                    body["resync"] = True
+                # Changes after this are all still listable for a while (see TOMBSTONE_RETENTION)
+                floor = now - TOMBSTONE_RETENTION / 2
+                cursor = floor if cursor is None or cursor < floor else cursor
+            else:
+                # A stop deleted and then re-created shows up as changed, not deleted
+                changed = {s['_doc_id']: s.get('updated_at') for s in stops}
+                deleted = []
+                for t in map_ref.collection("deleted_stops").where("deleted_at", ">", since_dt).stream():
+                    deleted_at = (t.to_dict() or {}).get('deleted_at')
+                    if cursor is None or deleted_at > cursor:
+                        cursor = deleted_at
+                    if t.id not in changed or changed[t.id] < deleted_at:
+                        deleted.append(t.id)
+                stops.sort(key=lambda s: s.get('id', 0))
+                body = {"stops": stops, "deleted": deleted,
+                        "map_meta": {"visible_fields": map_meta.get("visible_fields")}}
+
+            body["version"] = version
+            body["cursor"] = cursor.isoformat()
+            resp = jsonify(body)
+            resp.set_etag(etag)
+            resp.headers['Cache-Control'] = 'private, no-cache'
+            return resp
         except Exception as e:
             app.logger.exception("api_get_stops error: %s", e)
             return jsonify({"error": "failed to fetch stops"}), 500
@@ -557,11 +1076,18 @@ def create_app():
     @app.route('/api/stops/reorder', methods=['POST'])
     @login_required
     def api_reorder_stops():
+        """
+        Save a new stop order, rewriting only the stops whose position changed.
+        Expects JSON with map_id (and optionally owner_id) plus either
+          "order": [doc_id, ...]                      the full new order, or
+          "move": doc_id, "before": doc_id | null     move one stop in front of another (null = to the end)
+        """
         uid = session.get('uid')
         payload = request.get_json(silent=True) or {}
         map_id = payload.get('map_id') or session.get('current_map_id')
         owner_id = payload.get('owner_id') or uid
         order_list = payload.get('order') or []
+        move = payload.get('move')
 
         if not map_id:
             return jsonify({"error": "missing map_id"}), 400
@@ -578,41 +1104,337 @@ def create_app():
             return jsonify({"error": "access denied"}), 403
 
         try:
-            batch = db.batch()
             coll_base = db.collection("users").document(owner_id).collection("maps").document(map_id).collection("stops")
-            i = 1
-            for doc_id in order_list:
-                if not isinstance(doc_id, str):
-                    continue
-                doc_ref = coll_base.document(doc_id)
-                batch.update(doc_ref, {"id": i})
-                i += 1
+            current = sorted(
+                ((doc.id, (doc.to_dict() or {}).get("id")) for doc in coll_base.select(["id"]).stream()),
+                key=lambda d: (d[1] is None, d[1] or 0)
+            )
+            # Stops without an id sort last and are numbered as if they had just been added
+            ids = {}
+            for doc_id, stop_id in current:
+                ids[doc_id] = stop_id if stop_id is not None else max(ids.values(), default=0) + SEQ_GAP
 
-            if i > 1:
-                batch.commit()
-                return jsonify({"status": "ok", "saved_count": i-1}), 200
-            else:
+            try:
+                desired = desired_order([d for d, _ in current], order=order_list,
+                                        move=move, before=payload.get('before'))
+            except KeyError as e:
+                return jsonify({"error": f"unknown stop {e}"}), 404
+
+            changes = plan_reorder(ids, desired)
+            for doc_id, stop_id in current:
+                if stop_id is None:
+                    changes.setdefault(doc_id, ids[doc_id])
+            if not changes:
                 return jsonify({"status": "ok", "saved_count": 0}), 200
 
+            # Ids past the end must not be handed out again to new stops
+            raise_sequence_floor(owner_id, map_id, max(changes.values()))
+            commit_stop_writes(owner_id, map_id, [('update', coll_base.document(doc_id), {"id": stop_id}) for doc_id, stop_id in changes.items()])
+            stops_changed(owner_id, map_id)
+            return jsonify({"status": "ok", "saved_count": len(changes)}), 200
+
         except Exception as e:
             app.logger.exception("api_reorder_stops error: %s", e)
             return jsonify({"error": "failed to save new order"}), 500
 
 
+    # Seconds the route search may take, leaving room for the reads around it
+    OPTIMIZE_TIME_BUDGET = 0.5
 
+    def drive_time_matrix(rows):
+        """
+        Return (matrix, estimated): driving seconds between every pair of rows, and
+        the share of pairs that had to be estimated. Legs stored on the stops are
+        used first, then the leg cache, and any other pair is estimated from the
+        straight-line distance.
+        """
+        n = len(rows)
+        gmaps_ids = [row.get('gmaps_id') for row in rows]
+        known = leg_cache.get_many([g for g in gmaps_ids if g])
+        for row in rows:
+            leg = row.get('leg')
+            if isinstance(leg, dict) and leg.get('seconds') is not None:
+                known[(leg.get('origin'), leg.get('destination'))] = leg
+
+        coords = np.array([[row.get('lat', np.nan), row.get('lng', np.nan)] for row in rows], dtype=float)
+        matrix = estimated_seconds(haversine_matrix(coords))
+        is_known = np.zeros((n, n), dtype=bool)
+        for i, origin in enumerate(gmaps_ids):
+            for j, destination in enumerate(gmaps_ids):
+                leg = known.get((origin, destination)) if origin and destination and i != j else None
+                if leg is not None:
+                    matrix[i, j] = leg['seconds']
+                    is_known[i, j] = True
+
+        # Stops without coordinates get the slowest leg we know of rather than no cost at all
+        missing = np.isnan(matrix)
+        if missing.any():
+            matrix[missing] = np.nanmax(matrix) if not missing.all() else 0.0
+        np.fill_diagonal(matrix, 0.0)
+        np.fill_diagonal(is_known, True)
+
+        estimated = 1 - is_known.sum() / (n * n) if n else 0.0
+        return matrix, float(estimated)
+
+
+    @app.route('/api/stops/optimize', methods=['POST'])
+    @login_required
+    def api_optimize_stops():
+        """
+        Propose a faster order for a map's driving stops. Nothing is saved.
+        Expects JSON with map_id (and optionally owner_id) plus
+          "loop": true | false      return to the start after the last stop (default true)
+          "start": doc_id | "any"   first driving stop (default: the current first one)
+          "end": doc_id | "any"     last driving stop when not looping (default: the current last one)
+        The returned full_order can be posted to /api/stops/reorder as "order". When the
+        current order doesn't start/end where asked, saved_seconds can be negative.
+        """
+        uid = session.get('uid')
+        payload = request.get_json(silent=True) or {}
+        map_id = payload.get('map_id') or session.get('current_map_id')
+        owner_id = payload.get('owner_id') or uid
+        loop = payload.get('loop', True) is not False
 
+        if not map_id:
+            return jsonify({"error": "missing map_id"}), 400
+
+        db = getattr(app, 'db', None)
+        if db is None:
+            return jsonify({"error": "firestore not configured"}), 500
+
+        allowed, map_doc = check_map_access(owner_id, map_id, uid)
+        if not allowed:
+            return jsonify({"error": "access denied"}), 403
+
+        try:
+            coll_base = db.collection("users").document(owner_id).collection("maps").document(map_id).collection("stops")
+            docs = coll_base.select(["id", "drive", "gmaps_id", "lat", "lng", "leg"]).stream()
+            current = sorted(
+                ((doc.id, doc.to_dict() or {}) for doc in docs),
+                key=lambda d: (d[1].get("id") is None, d[1].get("id") or 0)
+            )
+            drives = [(doc_id, row) for doc_id, row in current if row.get('drive') == 'y']
+            drive_ids = [doc_id for doc_id, _ in drives]
+            position = {doc_id: i for i, doc_id in enumerate(drive_ids)}
+
+            # With one driving stop (or none) there is nothing to reorder and no distinct endpoints to ask for
+            if len(drives) < 2:
+                return jsonify({
+                    "status": "ok",
+                    "order": drive_ids,
+                    "full_order": [doc_id for doc_id, _ in current],
+                    "loop": loop,
+                    "current_seconds": 0,
+                    "proposed_seconds": 0,
+                    "saved_seconds": 0,
+                    "estimated_share": 0.0,
+                }), 200
+
+            def endpoint(name, default):
+                value = payload.get(name)
+                if value == 'any':
+                    return None
+                if value is None:
+                    return default
+                if value not in position:
+                    raise KeyError(value)
+                return position[value]
+
+            try:
+                start = endpoint('start', 0)
+                end = None if loop else endpoint('end', len(drives) - 1)
+            except KeyError as e:
+                return jsonify({"error": f"unknown driving stop {e}"}), 404
+            if start is not None and start == end:
+                return jsonify({"error": "start and end must be different stops"}), 400
+
+            matrix, estimated = drive_time_matrix([row for _, row in drives])
+            identity = list(range(len(drives)))
+            proposed = optimize_order(matrix, loop=loop, start=start, end=end, time_budget=OPTIMIZE_TIME_BUDGET)
+
+            current_seconds = route_cost(identity, matrix, loop) if drives else 0.0
+            proposed_seconds = route_cost(proposed, matrix, loop) if drives else 0.0
+
+            # Keep the current order when it is no slower, but only if it already
+            # starts and ends where asked (a loop can start anywhere, so it is
+            # rotated to start). Otherwise the constrained order stands, even if slower.
+            if loop:
+                current_order = identity[start:] + identity[:start] if start else identity
+                satisfied = True
+            else:
+                current_order = identity
+                satisfied = start in (None, 0) and end in (None, len(drives) - 1)
+            if satisfied and proposed_seconds >= current_seconds:
+                proposed, proposed_seconds = current_order, current_seconds
+
+            # Other stops keep their places; the driving slots are refilled in the new order
+            new_drives = iter(drive_ids[i] for i in proposed)
+            full_order = [next(new_drives) if row.get('drive') == 'y' else doc_id for doc_id, row in current]
+
+            return jsonify({
+                "status": "ok",
+                "order": [drive_ids[i] for i in proposed],
+                "full_order": full_order,
+                "loop": loop,
+                "current_seconds": round(current_seconds),
+                "proposed_seconds": round(proposed_seconds),
+                "saved_seconds": round(current_seconds - proposed_seconds),
+                "estimated_share": round(estimated, 3),
+            }), 200
+
+        except Exception as e:
+            app.logger.exception("api_optimize_stops error: %s", e)
+            return jsonify({"error": "failed to optimize stop order"}), 500
 
 
     # -------------------------
     # Firestore-based Roadtrips
     # -------------------------
 
+    def load_map_rows(owner_id, map_id):
+        stops = app.db.collection("users") \
+                .document(owner_id) \
+                .collection("maps") \
+                .document(map_id) \
+                .collection("stops") \
+                .order_by("id") \
+                .stream()
+        return [doc.to_dict() for doc in stops]
+
+
+    def render_map(owner_id, map_id, rows, preview=False):
+        """
+        Return (content_hash, entry) for the rendered map of these rows.
+        Renders are looked up in memory, then in the shared artifact store, and
+        only generated when neither has them. A preview never waits for Google:
+        legs that aren't already known are estimated. A render with legs estimated
+        because Google couldn't be asked is served but not kept (entry['pending']),
+        so the next view tries Google again instead of reusing it.
+        """
+        offline = True if preview else None
+        key = map_content_hash(map_id, owner_id, rows, offline)
+        entry = render_cache.get(key)
+        if entry is None:
+            html = map_artifacts.read(map_id, key, 'page.html')
+            if html is not None:
+                entry = {'html': html}
+            else:
+                html, download_html, pending = generate_map(map_id, owner_id, rows, offline)
+                entry = {'html': html, 'pending': pending}
+                if pending:
+                    return key, entry
+                map_artifacts.put(map_id, key, 'page.html', html)
+                map_artifacts.put(map_id, key, 'download.html', download_html)
+            render_cache.put(owner_id, map_id, key, entry)
+        return key, entry
+
+
+    # How long opening a map waits for a re-render already in progress
+    RENDER_WAIT_SECONDS = float(os.environ.get('RENDER_WAIT_SECONDS', 60))
+
+    def prerender_map(owner_id, map_id, refresh_legs):
+        """Background job queued by stops_changed: refresh the stored legs if asked, then render."""
+        if refresh_legs:
+            refresh_map_legs(owner_id, map_id)
+        render_map(owner_id, map_id, load_map_rows(owner_id, map_id))
+
+    app.render_jobs = MapRenderJobs(prerender_map)
+
+    missing_assets = VendoredAssets().missing()
+    if missing_assets:
+        app.logger.error("%d vendored assets missing, map downloads are disabled until "
+                         "python -m Utility.bundle fetch is run: %s", len(missing_assets), ", ".join(missing_assets))
+
+
+    def serve_map(owner_id, map_id):
+        """
+        Respond with the rendered map, reusing a cached render when nothing that
+        feeds into it has changed. The content hash doubles as a strong ETag so an
+        unchanged map costs the browser a 304. ?preview=1 serves the map with
+        estimated legs instead of waiting for Google.
+        """
+        preview = request.args.get('preview') == '1'
+        if not preview:
+            # Wait for a re-render already under way rather than starting a second one
+            app.render_jobs.wait(owner_id, map_id, RENDER_WAIT_SECONDS)
+        rows = load_map_rows(owner_id, map_id)
+
+        key, entry = render_map(owner_id, map_id, rows, preview=preview)
+        session['last_map'] = [owner_id, map_id, key]
+
+        resp = Response(entry['html'], mimetype='text/html')
+        if entry.get('pending'):
+            # The same content hash will name the fully routed render, so this one gets no ETag
+            resp.headers['Cache-Control'] = 'no-store'
+            return resp
+        resp.set_etag(key)
+        resp.headers['Cache-Control'] = 'private, no-cache'
+        return resp.make_conditional(request)
+
+
     @app.route('/download_current_map')
     def download_current_map():
-        path = session.get('last_map_path')
-        if path and os.path.exists(path):
-            return send_file(path, as_attachment=True, download_name="my_roadtrip.html")
-        return "File expired or not found", 404
+        """
+        Download the last opened map without its sidebar or buttons, as one HTML file
+        with its scripts and stylesheets inlined for offline viewing (see
+        Utility.bundle). ?format=zip sends it zipped; otherwise it is sent gzip
+        encoded to clients that accept that. The file is looked up by map id and
+        content hash; if it has been evicted, the map is rendered again from its
+        current stops. Answers 503 until the vendored assets have been fetched.
+        """
+        last = session.get('last_map')
+        if not last:
+            return "File expired or not found", 404
+        owner_id, map_id, key = last
+
+        # A render with pending legs (see render_map) is sent but nothing built from it is kept
+        pending = False
+        data = map_artifacts.read(map_id, key, 'download.html')
+        if data is None and getattr(app, 'db', None) and session.get('uid'):
+            allowed, _ = check_map_access(owner_id, map_id, session['uid'], require_write=False)
+            if allowed:
+                try:
+                    rows = load_map_rows(owner_id, map_id)
+                    key = map_content_hash(map_id, owner_id, rows)
+                    data = map_artifacts.read(map_id, key, 'download.html')
+                    if data is None:
+                        html, data, pending = generate_map(map_id, owner_id, rows)
+                        if not pending:
+                            map_artifacts.put(map_id, key, 'page.html', html)
+                            map_artifacts.put(map_id, key, 'download.html', data)
+                except Exception as e:
+                    app.logger.exception("Error re-rendering map %s for download: %s", map_id, e)
+
+        if data is None:
+            return "File expired or not found", 404
+
+        # Bundles are cached per render and per set of vendored assets
+        assets = VendoredAssets()
+        variant = f"bundle-{assets.fingerprint()}.html.gz"
+        bundle = map_artifacts.read(map_id, key, variant)
+        if bundle is None:
+            try:
+                bundle = gzip_bundle(build_bundle(data, assets))
+            except RuntimeError as e:
+                app.logger.error("Cannot bundle map %s for download: %s", map_id, e)
+                return "Offline download unavailable: the server's vendored assets have not been fetched", 503
+            if not pending:
+                map_artifacts.put(map_id, key, variant, bundle)
+
+        if request.args.get('format') == 'zip':
+            zipped = map_artifacts.read(map_id, key, variant + '.zip')
+            if zipped is None:
+                zipped = zip_bundle(gzip.decompress(bundle))
+                if not pending:
+                    map_artifacts.put(map_id, key, variant + '.zip', zipped)
+            return send_file(io.BytesIO(zipped), mimetype='application/zip', as_attachment=True, download_name="my_roadtrip.zip")
+
+        if 'gzip' not in request.accept_encodings:
+            return send_file(io.BytesIO(gzip.decompress(bundle)), mimetype='text/html', as_attachment=True, download_name="my_roadtrip.html")
+        resp = send_file(io.BytesIO(bundle), mimetype='text/html', as_attachment=True, download_name="my_roadtrip.html")
+        resp.headers['Content-Encoding'] = 'gzip'
+        resp.headers['Vary'] = 'Accept-Encoding'
+        return resp
 
 
     @app.route('/delete_map', methods=['POST'])
@@ -645,9 +1467,15 @@ def create_app():
 
             # 3. Delete the map document
             # Note: In Firestore, deleting a document does NOT automatically delete
-            # its subcollections (like 'stops' or 'planning'). They will become
-            # orphaned but will no longer appear in your list.
+            # its subcollections (like 'stops' or 'planning'), so a background job
+            # is recorded first and started once the map is gone, so a failed
+            # delete never leaves a live map without its stops. See
+            # /api/delete_status for progress.
+            app.deletion_jobs.record(uid, map_id)
             map_ref.delete()
+            render_cache.invalidate(uid, map_id)
+            invalidate_map_access(uid, map_id)
+            app.deletion_jobs.start(uid, map_id)
 
             flash("Roadtrip deleted successfully.", "success")
 
@@ -658,6 +1486,46 @@ def create_app():
         return redirect(url_for('roadtrips'))
 
 
+    @app.route('/api/delete_status')
+    @login_required
+    def api_delete_status():
+        """
+        Progress of removing a deleted map's stops and other subcollections.
+        Query params: map_id (required). Only the owner's own maps can be queried.
+        """
+        uid = session.get('uid')
+        map_id = request.args.get('map_id')
+        if not map_id:
+            return jsonify({"error": "missing map_id"}), 400
+        if app.deletion_jobs is None:
+            return jsonify({"error": "firestore not configured"}), 500
+
+        job = app.deletion_jobs.status(uid, map_id)
+        return jsonify(job or {"state": "none"}), 200
+
+
+    @app.route('/api/render_status')
+    @login_required
+    def api_render_status():
+        """
+        Whether a map is being re-rendered after an edit, so the UI can say so.
+        Query params: map_id (required), owner_id (defaults to the current user).
+        """
+        uid = session.get('uid')
+        map_id = request.args.get('map_id')
+        owner_id = request.args.get('owner_id') or uid
+        if not map_id:
+            return jsonify({"error": "missing map_id"}), 400
+
+        allowed, _ = check_map_access(owner_id, map_id, uid, require_write=False)
+        if not allowed:
+            return jsonify({"error": "access denied"}), 403
+
+        status = app.render_jobs.status(owner_id, map_id)
+        status["updating"] = status["state"] in ("queued", "running")
+        return jsonify(status), 200
+
+
     @app.route('/map/<owner_id>/<map_id>')
     @login_required
     def open_map_shared(owner_id, map_id):
@@ -677,27 +1545,11 @@ def create_app():
             return "Access denied", 403
 
         try:
-            stops = db.collection("users") \
-                    .document(owner_id) \
-                    .collection("maps") \
-                    .document(map_id) \
-                    .collection("stops") \
-                    .order_by("id") \
-                    .stream()
-
-            rows = [doc.to_dict() for doc in stops]
-
             # remember which map is active and where it is owned
             session['current_map_id'] = map_id
             session['current_map_owner'] = owner_id
 
-            # 1. Generate the basic Map HTML
-            tf = generate_map(map_id, owner_id, rows)
-
-            try:
-                return send_file(tf.name, mimetype='text/html')
-            finally:
-                pass
+            return serve_map(owner_id, map_id)
 
         except Exception as e:
             app.logger.exception("Error opening map %s for user %s: %s", map_id, uid, e)
@@ -720,118 +1572,127 @@ def create_app():
             return "Firestore not configured", 500
 
         try:
-            stops = app.db.collection("users") \
-                    .document(uid) \
-                    .collection("maps") \
-                    .document(map_id) \
-                    .collection("stops") \
-                    .order_by("id") \
-                    .stream()
-
-            rows = [doc.to_dict() for doc in stops]
-
             # Keep session small: remember which map is active
             session['current_map_id'] = map_id
             session['current_map_owner'] = uid # For owned maps, owner is self
 
-            # 1. Generate Map
-            tf = generate_map(map_id, uid, rows)
-
-            # 2. Inject Sidebar
-            fb_config = {
-                "apiKey": os.environ.get('FIREBASE_API_KEY'),
-                "authDomain": os.environ.get('FIREBASE_AUTH_DOMAIN'),
-                "projectId": os.environ.get('FIREBASE_PROJECT_ID'),
-                "storageBucket": os.environ.get('FIREBASE_STORAGE_BUCKET'),
-                "messagingSenderId": os.environ.get('FIREBASE_MESSAGING_SENDER_ID'),
-                "appId": os.environ.get('FIREBASE_APP_ID')
-            }
-
-            insert_sidebar(tf.name, map_id, uid, firebase_config=fb_config)
-
-            try:
-                return send_file(tf.name, mimetype='text/html')
-            finally:
-                # optionally remove file after some time / or use delete=True for immediate cleanup
-                pass
+            return serve_map(uid, map_id)
 
         except Exception as e:
             app.logger.exception("Error opening map %s for user %s: %s", map_id, uid, e)
             return "Error", 500
 
 
+    # Listing page sizes for /roadtrips
+    DEFAULT_PAGE_SIZE = 25
+    MAX_PAGE_SIZE = 100
+
+    # Only what the listing shows is read from each map document
+    LISTING_FIELDS = ['name', 'created_at']
+
+    listing_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='roadtrips')
+
+    def listing_row(d, owner_id):
+        data = d.to_dict() or {}
+        created = data.get('created_at')
+        return {
+            "id": d.id,
+            "name": data.get('name') or "(unnamed)",
+            "created_at": created.isoformat() if hasattr(created, 'isoformat') else str(created),
+            "owner": owner_id
+        }
+
+    def list_owned_maps(db, uid, page_size, cursor=None):
+        """One page of the user's own maps, newest first. Returns (rows, next_cursor)."""
+        coll = db.collection("users").document(uid).collection("maps")
+        query = coll.order_by("created_at", direction=fb_firestore.Query.DESCENDING).select(LISTING_FIELDS)
+        if cursor:
+            snap = coll.document(cursor).get()
+            if snap.exists:
+                query = query.start_after(snap)
+
+        docs = list(query.limit(page_size + 1).stream())
+        rows = [listing_row(d, uid) for d in docs[:page_size]]
+        next_cursor = docs[page_size - 1].id if len(docs) > page_size else None
+        return rows, next_cursor
+
+    def list_shared_maps(db, uid, page_size, cursor=None):
+        """
+        One page of maps shared with the user (collection-group 'maps' where
+        collaborator_uids array contains uid). Cursors are "owner_id/map_id".
+        Returns (rows, next_cursor).
+        """
+        query = db.collection_group("maps").where("collaborator_uids", "array_contains", uid).select(LISTING_FIELDS)
+        if cursor and cursor.count('/') == 1:
+            owner_id, map_id = cursor.split('/')
+            snap = db.collection("users").document(owner_id).collection("maps").document(map_id).get()
+            if snap.exists:
+                query = query.start_after(snap)
+
+        docs = list(query.limit(page_size + 1).stream())
+        rows = []
+        for d in docs[:page_size]:
+            # skip maps owned by the current user (avoid duplicating owned maps)
+            owner_ref = d.reference.parent.parent
+            owner_id = owner_ref.id if owner_ref else None
+            if owner_id != uid:
+                rows.append(listing_row(d, owner_id))
+
+        next_cursor = None
+        if len(docs) > page_size:
+            last = docs[page_size - 1]
+            next_cursor = f"{last.reference.parent.parent.id}/{last.id}"
+        return rows, next_cursor
+
     @app.route('/roadtrips')
     @login_required
     def roadtrips():
         """
-        List roadtrips for current user:
+        List roadtrips for current user, a page at a time:
          - maps they own (users/{uid}/maps)
          - maps shared with them (collection-group 'maps' where collaborator_uids array contains uid)
+        Query params: page_size, owned_cursor, shared_cursor (from the "next page" links)
         """
         owned_roadmaps = []
         shared_roadmaps = []
+        next_owned = next_shared = None
         uid = session.get('uid')
         db = getattr(app, 'db', None)
         if not db:
             app.logger.warning("Firestore not configured - roadtrips cannot be loaded")
             return render_template('roadtrips.html', owned_roadtrips=owned_roadmaps, shared_roadtrips=shared_roadmaps)
 
-        # 1) Owned maps
+        page_size = request.args.get('page_size', DEFAULT_PAGE_SIZE, type=int)
+        page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+        owned_cursor = request.args.get('owned_cursor')
+        shared_cursor = request.args.get('shared_cursor')
+
+        # Both listings are independent, so run them at the same time
+        owned_job = listing_pool.submit(list_owned_maps, db, uid, page_size, owned_cursor)
+        shared_job = listing_pool.submit(list_shared_maps, db, uid, page_size, shared_cursor)
+
         try:
-            coll = db.collection("users").document(uid).collection("maps")
-            try:
-                docs = coll.order_by("created_at", direction=fb_firestore.Query.DESCENDING).stream()
-            except Exception:
-                docs = coll.stream()
-            for d in docs:
-                data = d.to_dict() or {}
-                name = data.get('name') or "(unnamed)"
-                created = data.get('created_at')
-                created_str = created.isoformat() if hasattr(created, 'isoformat') else str(created)
-                filename = data.get('filename')
-                owned_roadmaps.append({
-                    "id": d.id,
-                    "name": name,
-                    "created_at": created_str,
-                    "filename": filename,
-                    "owner": uid
-                })
+            owned_roadmaps, next_owned = owned_job.result()
         except Exception as e:
             app.logger.exception("Error listing user's own roadmaps: %s", e)
 
-        # 2) Shared maps: search across all users/*/maps using a collection-group query
         try:
-            # Query maps where the 'collaborator_uids' array contains the current user's uid
-            query = db.collection_group("maps").where("collaborator_uids", "array_contains", uid)
-            shared_docs = list(query.stream())
-
-            for d in shared_docs:
-                # skip maps owned by the current user (avoid duplicating owned maps)
-                owner_ref = d.reference.parent.parent
-                owner_id = owner_ref.id if owner_ref else None
-                if owner_id == uid:
-                    continue
-
-                data = d.to_dict() or {}
-                name = data.get('name') or "(unnamed)"
-                created = data.get('created_at')
-                created_str = created.isoformat() if hasattr(created, 'isoformat') else str(created)
-                filename = data.get('filename')
-
-                shared_roadmaps.append({
-                    "id": d.id,
-                    "name": name,
-                    "created_at": created_str,
-                    "filename": filename,
-                    "owner": owner_id
-                })
+            shared_roadmaps, next_shared = shared_job.result()
         except Exception as e:
             app.logger.exception("Error listing shared roadmaps: %s", e)
 
+        def page_url(owned=owned_cursor, shared=shared_cursor):
+            return url_for('roadtrips', page_size=page_size, owned_cursor=owned, shared_cursor=shared)
+
         # Render template with both lists
         return render_template('roadtrips.html',
                                owned_roadtrips=owned_roadmaps,
-                               shared_roadtrips=shared_roadmaps)
+                               shared_roadtrips=shared_roadmaps,
+                               owned_next_url=page_url(owned=next_owned) if next_owned else None,
+                               shared_next_url=page_url(shared=next_shared) if next_shared else None,
+                               first_page_url=url_for('roadtrips', page_size=page_size)
+                                   if owned_cursor or shared_cursor else None,
+                               importing=request.args.get('importing'))
 
 
 
@@ -846,37 +1707,74 @@ def create_app():
         filename_safe = secure_filename(name) or "roadtrip"
         csv_filename = f"{filename_safe}.csv"
 
+        # The upload is copied to a temporary file as it is read, never held in memory whole
         fileobj = request.files.get('file')
+        upload = None
         if fileobj and fileobj.filename:
             try:
-                raw = fileobj.read()
-                try:
-                    csv_text = raw.decode('utf-8')
-                except UnicodeDecodeError:
-                    csv_text = raw.decode('latin-1')
+                upload = spool_csv_upload(fileobj.stream, MAX_IMPORT_BYTES)
+            except ValueError:
+                app.logger.warning("Uploaded CSV larger than %d bytes", MAX_IMPORT_BYTES)
+                return f"CSV too large (max {MAX_IMPORT_BYTES} bytes)", 400
             except Exception as e:
                 app.logger.exception("Failed to read uploaded file: %s", e)
                 return "Failed to read file", 400
-        else:
-            csv_text = "Location ID	Nickname, Name, Description, Overnight, Include Drive, Link Titles, Links, Gmaps ID, Latitude, Longitude\n"
-
-
-        # Safety: enforce conservative size cap (900 KB)
-        MAX_BYTES = 900 * 1024
-        csv_bytes = csv_text.encode('utf-8')
-        if len(csv_bytes) > MAX_BYTES:
-            app.logger.warning("Uploaded CSV too large (%d bytes) for Firestore storage", len(csv_bytes))
-            return f"CSV too large for Firestore storage (max {MAX_BYTES} bytes)", 400
 
         try:
             new_id = create_roadmap_doc(session['uid'], name)
             app.logger.info("Created roadmap doc %s for user %s", new_id, session['uid'])
-            # Redirect back to the list so the user can view and add roadtrips
-            return redirect(url_for('roadtrips'))
         except Exception as e:
             app.logger.exception("Failed to create roadmap doc: %s", e)
+            if upload:
+                os.remove(upload[0])
             return "Failed to create roadmap", 500
 
+        if upload:
+            # Geocoding a large file takes a while, so it runs in the background
+            # and the list page polls /api/import_status until it's done
+            try:
+                app.db.collection("users").document(session['uid']).collection("maps").document(new_id).update(
+                    {"import": import_status("queued")})
+                app.import_jobs.enqueue(session['uid'], new_id, *upload)
+            except Exception as e:
+                app.logger.exception("Failed to start importing CSV into map %s: %s", new_id, e)
+                os.remove(upload[0])
+                flash("The roadtrip was created but importing the CSV failed.", "error")
+                return redirect(url_for('roadtrips'))
+            return redirect(url_for('roadtrips', importing=new_id))
+
+        # Redirect back to the list so the user can view and add roadtrips
+        return redirect(url_for('roadtrips'))
+
+
+    @app.route('/api/import_status')
+    @login_required
+    def api_import_status():
+        """
+        Progress of the last CSV import into a map.
+        Query params: map_id (required), owner_id (optional)
+        An import whose heartbeat is older than IMPORT_STALE_SECONDS is reported as failed.
+        """
+        uid = session.get('uid')
+        map_id = request.args.get('map_id')
+        owner_id = request.args.get('owner_id') or uid
+        if not map_id:
+            return jsonify({"error": "missing map_id"}), 400
+
+        allowed, map_doc = check_map_access(owner_id, map_id, uid, require_write=False)
+        if not allowed:
+            return jsonify({"error": "access denied"}), 403
+
+        # read fresh: the ACL cache may hold a snapshot from before the import
+        map_doc = app.db.collection("users").document(owner_id).collection("maps").document(map_id).get()
+        status = (map_doc.to_dict() or {}).get("import") or {"state": "none"}
+        heartbeat_at = status.pop("heartbeat_at", None)
+        if status["state"] in ("queued", "geocoding", "writing"):
+            cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=IMPORT_STALE_SECONDS)
+            if heartbeat_at is None or heartbeat_at < cutoff:
+                status.update(state="failed", error="the import stopped before finishing")
+        return jsonify(status), 200
+
 
 
 
@@ -950,6 +1848,20 @@ def create_app():
         session.pop('uid', None)
         return redirect(url_for('sign_up'))
 
+    @app.route('/metrics')
+    def metrics_endpoint():
+        """
+        Prometheus text-format metrics of this worker process: request, Google Maps,
+        Firestore and render/injection/file timings, labelled by route.
+        Only served when METRICS_TOKEN is set, to requests sending it as a Bearer token.
+        """
+        token = os.environ.get('METRICS_TOKEN')
+        if not token:
+            abort(404)
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(401)
+        return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
     @app.route('/_health')
     def health():
         info = {}
@@ -957,6 +1869,9 @@ def create_app():
             info['firebase'] = bool(app.db)
         except Exception:
             info['firebase'] = False
+        info['geocode_cache'] = geocode_cache.stats()
+        info['render_cache'] = render_cache.stats()
+        info['acl_cache'] = acl_cache.stats()
         return jsonify(info), 200
 
 
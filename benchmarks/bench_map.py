@@ -0,0 +1,263 @@
+"""
+Benchmarks for building a map, stage by stage, on synthetic trips.
+
+    python -m benchmarks.bench_map                      # default sizes, results to benchmarks/results/
+    python -m benchmarks.bench_map --sizes 10 100 --latency 0.02
+    python -m benchmarks.bench_map --baseline benchmarks/results/v1.json
+
+For every trip size each stage records wall time, peak traced memory (from a
+second, traced pass so tracing doesn't distort the timings), output size
+(where the stage produces HTML) and the calls made to the fake Google Maps
+client and the in-memory Firestore. Results are written as JSON; with
+--baseline the run is compared against an earlier results file and the
+process exits with status 1 if any stage got slower or bigger than allowed.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# The caches must not touch the real ones, and googlemaps.Client needs a key of the right shape
+CACHE_DIR = tempfile.mkdtemp(prefix='roadtrip-bench-')
+os.environ['ROADTRIP_CACHE_DIR'] = CACHE_DIR
+os.environ.pop('LEG_CACHE_PATH', None)
+os.environ.pop('GEOCODE_CACHE_PATH', None)
+os.environ.setdefault('GOOGLE_MAPS_KEY', 'AIza' + '0' * 35)
+
+import folium
+
+import make_map
+import Utility.utility_functions as utility_functions
+from Utility.caches import leg_cache
+from Utility.html_edits import insert_buttons, insert_sidebar, split_at_body_end, sidebar_html, buttons_html
+from Utility.plotting_functions import add_pin
+from Utility.utility_functions import load_from_fb_format, plot_drives
+
+from benchmarks.fakes import FakeGoogleMaps, FakeFirestore
+from benchmarks.trips import trip_rows
+
+DEFAULT_SIZES = [10, 100, 500, 1000, 5000]
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+
+# Firestore's own limit is 500; the app uses 450 per batch
+BATCH_SIZE = 450
+
+
+class Stage:
+    """Times one stage and records memory and external calls made during it."""
+
+    def __init__(self, results, name, gmaps, db, trace_memory):
+        self.results = results
+        self.name = name
+        self.gmaps = gmaps
+        self.db = db
+        self.trace_memory = trace_memory
+        self.html_bytes = None
+
+    def __enter__(self):
+        self.gmaps_before = dict(self.gmaps.calls)
+        self.db_before = dict(self.db.calls)
+        if self.trace_memory:
+            tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.start
+        peak = None
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if exc_type is not None:
+            return False
+
+        diff = lambda now, before: {k: v - before.get(k, 0) for k, v in now.items() if v - before.get(k, 0)}
+        self.results[self.name] = {
+            'wall_s': round(wall, 4),
+            'peak_mem_bytes': peak,
+            'html_bytes': self.html_bytes,
+            'gmaps_calls': diff(self.gmaps.calls, self.gmaps_before),
+            'firestore_calls': diff(self.db.calls, self.db_before),
+        }
+
+
+def bench_size(n, latency, trace_memory, workdir):
+    rows, places = trip_rows(n, seed=n)
+    gmaps = FakeGoogleMaps(places, latency=latency)
+    db = FakeFirestore()
+    utility_functions.gmaps = gmaps
+    leg_cache.clear()
+
+    results = {}
+    stage = lambda name: Stage(results, name, gmaps, db, trace_memory)
+    stops = db.collection('users').document('bench').collection('maps').document(f'trip{n}').collection('stops')
+
+    with stage('firestore_save'):
+        for start in range(0, len(rows), BATCH_SIZE):
+            batch = db.batch()
+            for row in rows[start:start + BATCH_SIZE]:
+                batch.set(stops.document(row['name']), row)
+            batch.commit()
+
+    with stage('firestore_load'):
+        loaded = [d.to_dict() for d in stops.order_by('id').stream()]
+    assert len(loaded) == n
+
+    with stage('load_from_fb_format'):
+        all_stops, driving_stops, other_stops = load_from_fb_format(loaded)
+
+    coords = all_stops.get_all_coords()
+    m = folium.Map(location=coords[0], zoom_start=8)
+
+    with stage('add_pin'):
+        add_pin(m, driving_stops)
+        add_pin(m, other_stops)
+
+    with stage('plot_drives'):
+        plot_drives(m, driving_stops, driving_stops.get_all_gmapsids())
+
+    with stage('folium_render') as s:
+        page = m.get_root().render()
+        s.html_bytes = len(page.encode('utf-8'))
+
+    with stage('inject_in_memory') as s:
+        before, after = split_at_body_end(page)
+        html = ''.join((before, sidebar_html('bench', 'bench', make_map.firebase_config()), '\n',
+                        buttons_html(make_map.map_buttons('bench')), '\n', after))
+        s.html_bytes = len(html.encode('utf-8'))
+
+    path = Path(workdir) / f'trip{n}.html'
+    path.write_text(page, encoding='utf-8')
+    with stage('inject_file') as s:
+        insert_sidebar(path, 'bench', 'bench', make_map.firebase_config())
+        insert_buttons(path, make_map.map_buttons('bench'))
+        s.html_bytes = path.stat().st_size
+
+    # End to end, first with nothing cached and then with every leg in the leg cache
+    leg_cache.clear()
+    with stage('generate_map_cold') as s:
+        html, download_html, _ = make_map.generate_map(f'trip{n}', 'bench', loaded)
+        s.html_bytes = len(html)
+
+    with stage('generate_map_warm') as s:
+        html, download_html, _ = make_map.generate_map(f'trip{n}', 'bench', loaded)
+        s.html_bytes = len(html)
+
+    return {
+        'stops': n,
+        'driving_stops': len(driving_stops.places),
+        'render_mode': make_map.render_mode(loaded),
+        'stages': results,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of regression messages for stages worse than baseline by more than tolerance."""
+    regressions = []
+    old_runs = {run['stops']: run for run in baseline.get('runs', [])}
+    for run in results['runs']:
+        old = old_runs.get(run['stops'])
+        if old is None:
+            continue
+        for name, stage in run['stages'].items():
+            before = old['stages'].get(name)
+            if before is None:
+                continue
+            for metric in ('wall_s', 'peak_mem_bytes', 'html_bytes'):
+                new_value, old_value = stage.get(metric), before.get(metric)
+                if new_value is None or not old_value:
+                    continue
+                # Very short stages are too noisy to compare on time
+                if metric == 'wall_s' and old_value < 0.01:
+                    continue
+                if new_value > old_value * (1 + tolerance):
+                    regressions.append(f"{run['stops']} stops / {name}: {metric} {old_value} -> {new_value}")
+            if stage['gmaps_calls'] != before.get('gmaps_calls'):
+                regressions.append(f"{run['stops']} stops / {name}: gmaps calls "
+                                   f"{before.get('gmaps_calls')} -> {stage['gmaps_calls']}")
+    return regressions
+
+
+def print_table(run):
+    print(f"\n{run['stops']} stops ({run['driving_stops']} driving, {run['render_mode']} render)")
+    print(f"  {'stage':<22}{'wall s':>10}{'peak MiB':>10}{'html KiB':>10}  calls")
+    for name, stage in run['stages'].items():
+        peak = f"{stage['peak_mem_bytes'] / 2 ** 20:.1f}" if stage['peak_mem_bytes'] is not None else '-'
+        size = f"{stage['html_bytes'] / 1024:.0f}" if stage['html_bytes'] is not None else '-'
+        calls = {**stage['gmaps_calls'], **stage['firestore_calls']}
+        print(f"  {name:<22}{stage['wall_s']:>10.3f}{peak:>10}{size:>10}  {calls or ''}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='trip sizes (number of stops)')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds per fake Google Maps call')
+    parser.add_argument('--no-memory', action='store_true',
+                        help="skip the second, memory-traced pass over each size")
+    parser.add_argument('--output', type=Path, help='results file (default: benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--baseline', type=Path, help='earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed growth before a stage counts as a regression')
+    args = parser.parse_args(argv)
+
+    started = datetime.now(timezone.utc)
+    results = {
+        'started_at': started.isoformat(),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency_s': args.latency,
+        'memory_traced': not args.no_memory,
+        'runs': [],
+    }
+
+    workdir = tempfile.mkdtemp(prefix='roadtrip-bench-html-')
+    try:
+        for n in args.sizes:
+            run = bench_size(n, args.latency, False, workdir)
+            # Tracing memory slows everything down, so peaks come from a second, traced pass
+            if not args.no_memory:
+                traced = bench_size(n, args.latency, True, workdir)
+                for name, stage in run['stages'].items():
+                    stage['peak_mem_bytes'] = traced['stages'][name]['peak_mem_bytes']
+            results['runs'].append(run)
+            print_table(run)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+    output = args.output or RESULTS_DIR / f"{started:%Y%m%dT%H%M%SZ}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2), encoding='utf-8')
+    print(f"\nResults written to {output}")
+
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text(encoding='utf-8')), args.tolerance)
+        for line in regressions:
+            print('REGRESSION', line)
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
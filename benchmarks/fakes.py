@@ -0,0 +1,203 @@
+"""
+Stand-ins for the external services used while building a map, so the
+benchmarks measure this code rather than the network. Both count their calls.
+"""
+import copy
+import math
+import time
+import threading
+from collections import Counter
+
+import polyline
+
+
+def haversine_km(a, b):
+    lat1, lng1, lat2, lng2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(h))
+
+
+class FakeGoogleMaps:
+    """
+    Answers the googlemaps.Client calls the app makes (find_place,
+    distance_matrix, directions) from a table of place id -> (lat, lng),
+    sleeping `latency` seconds per call. Routes are wiggly polylines of
+    `route_points` points between the two places, like a real road.
+    """
+
+    def __init__(self, places, latency=0.0, route_points=400):
+        self.places = places
+        self.latency = latency
+        self.route_points = route_points
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _leg(self, origin, destination):
+        km = haversine_km(self.places[origin], self.places[destination]) * 1.3
+        minutes = km / 80 * 60
+        return {
+            'status': 'OK',
+            'distance': {'text': f'{km:.0f} km', 'value': int(km * 1000)},
+            'duration': {'text': f'{minutes:.0f} mins', 'value': int(minutes * 60)},
+        }
+
+    def find_place(self, input, input_type='textquery', fields=None):
+        self._call('find_place')
+        place_id = f'fake-{abs(hash(input)) % 10 ** 8}'
+        lat, lng = 45 + (hash(input) % 1000) / 1000, 2 + (hash(input[::-1]) % 1000) / 1000
+        self.places.setdefault(place_id, (lat, lng))
+        return {'candidates': [{'place_id': place_id, 'geometry': {'location': {'lat': lat, 'lng': lng}}}]}
+
+    def distance_matrix(self, origins, destinations, mode='driving', units='metric'):
+        self._call('distance_matrix')
+        strip = lambda ids: [i[len('place_id:'):] if i.startswith('place_id:') else i for i in ids]
+        return {'rows': [
+            {'elements': [self._leg(o, d) for d in strip(destinations)]} for o in strip(origins)
+        ]}
+
+    def directions(self, origin, destination, mode='driving'):
+        self._call('directions')
+        strip = lambda i: i[len('place_id:'):] if i.startswith('place_id:') else i
+        (lat1, lng1), (lat2, lng2) = self.places[strip(origin)], self.places[strip(destination)]
+        n = self.route_points
+        points = [
+            (lat1 + (lat2 - lat1) * t + 0.01 * math.sin(t * 40), lng1 + (lng2 - lng1) * t + 0.01 * math.cos(t * 29))
+            for t in (k / (n - 1) for k in range(n))
+        ]
+        leg = self._leg(strip(origin), strip(destination))
+        return [{
+            'overview_polyline': {'points': polyline.encode(points)},
+            'legs': [{'distance': leg['distance'], 'duration': leg['duration']}],
+        }]
+
+
+class FakeFirestore:
+    """
+    In-memory Firestore covering what loading and saving stops uses:
+    collection/document paths, set/get/update/delete, where/order_by/limit
+    queries and batches. Documents are stored by full path; reads and writes
+    are counted per document like Firestore bills them.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.calls = Counter()
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+class FakeSnapshot:
+    def __init__(self, ref, data):
+        self.reference = ref
+        self.id = ref.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class FakeDocument:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name):
+        return FakeCollection(self.db, f'{self.path}/{name}')
+
+    def get(self):
+        self.db.calls['reads'] += 1
+        return FakeSnapshot(self, self.db.docs.get(self.path))
+
+    def set(self, data):
+        self.db.calls['writes'] += 1
+        self.db.docs[self.path] = copy.deepcopy(data)
+
+    def update(self, data):
+        self.db.calls['writes'] += 1
+        self.db.docs[self.path].update(copy.deepcopy(data))
+
+    def delete(self):
+        self.db.calls['writes'] += 1
+        self.db.docs.pop(self.path, None)
+
+
+class FakeQuery:
+    def __init__(self, db, path, filters=(), order=None, limit=None):
+        self.db = db
+        self.path = path
+        self._filters = filters
+        self._order = order
+        self._limit = limit
+
+    def where(self, field, op, value):
+        assert op == '==', 'only equality filters are faked'
+        return FakeQuery(self.db, self.path, self._filters + ((field, value),), self._order, self._limit)
+
+    def order_by(self, field, direction='ASCENDING'):
+        return FakeQuery(self.db, self.path, self._filters, (field, direction), self._limit)
+
+    def limit(self, count):
+        return FakeQuery(self.db, self.path, self._filters, self._order, count)
+
+    def stream(self):
+        prefix = self.path + '/'
+        rows = [
+            (path, data) for path, data in self.db.docs.items()
+            if path.startswith(prefix) and '/' not in path[len(prefix):]
+            and all(data.get(f) == v for f, v in self._filters)
+        ]
+        if self._order:
+            field, direction = self._order
+            rows = [r for r in rows if field in r[1]]
+            rows.sort(key=lambda r: r[1][field], reverse=direction == 'DESCENDING')
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        for path, data in rows:
+            self.db.calls['reads'] += 1
+            yield FakeSnapshot(FakeDocument(self.db, path), copy.deepcopy(data))
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, path):
+        super().__init__(db, path)
+
+    def document(self, doc_id):
+        return FakeDocument(self.db, f'{self.path}/{doc_id}')
+
+
+class FakeBatch:
+    # Firestore rejects larger batches, so the fake does too
+    MAX_WRITES = 500
+
+    def __init__(self, db):
+        self.db = db
+        self.ops = []
+
+    def set(self, ref, data):
+        self.ops.append(lambda: ref.set(data))
+
+    def update(self, ref, data):
+        self.ops.append(lambda: ref.update(data))
+
+    def delete(self, ref):
+        self.ops.append(ref.delete)
+
+    def commit(self):
+        if len(self.ops) > self.MAX_WRITES:
+            raise ValueError(f'{len(self.ops)} writes in one batch (max {self.MAX_WRITES})')
+        self.db.calls['commits'] += 1
+        for op in self.ops:
+            op()
+        self.ops = []
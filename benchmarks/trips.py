@@ -0,0 +1,63 @@
+"""
+Synthetic trips shaped like the ones users build: a chain of driving stops
+along a route, overnight stops at some of them, and most stops being points
+of interest scattered around the driving stops.
+"""
+import math
+import random
+
+# Share of each kind of stop; the rest are points of interest
+DRIVE_SHARE = 0.25
+SLEEP_SHARE = 0.10
+
+COLOURS = ['blue', 'red', 'green', 'purple', 'orange', 'darkred', 'cadetblue', 'darkgreen']
+
+
+def trip_rows(n, seed=0):
+    """
+    Return (rows, places): n stop rows in the format stored in Firestore (and
+    read by load_from_fb_format), and a gmaps_id -> (lat, lng) table for the
+    fake Google client.
+    """
+    rng = random.Random(seed)
+    rows = []
+    places = {}
+    drive_points = []
+
+    lat, lng = 44.0, -1.0
+    heading = rng.uniform(0, 2 * math.pi)
+
+    for i in range(n):
+        roll = rng.random()
+        if roll < DRIVE_SHARE or not drive_points:
+            kind = 'drive'
+            heading += rng.gauss(0, 0.4)
+            step = rng.uniform(0.3, 1.5)
+            lat += step * math.sin(heading)
+            lng += step * math.cos(heading)
+            point = (lat, lng)
+            drive_points.append(point)
+        else:
+            kind = 'sleep' if roll < DRIVE_SHARE + SLEEP_SHARE else 'poi'
+            base = rng.choice(drive_points[-5:])
+            point = (base[0] + rng.gauss(0, 0.1), base[1] + rng.gauss(0, 0.1))
+
+        gmaps_id = f'bench-{seed}-{i}'
+        places[gmaps_id] = point
+        name = f'Stop {i} ({kind})'
+        rows.append({
+            'id': i + 1,
+            'name': name,
+            'nickname': name if rng.random() < 0.5 else f'#{i}',
+            'desc': rng.choice(['', 'Nice view', 'Book ahead <b>early</b>', 'Fuel & snacks', 'x' * 400]),
+            'colour': rng.choice(COLOURS),
+            'drive': 'y' if kind == 'drive' else 'n',
+            'place_type': 'sleep' if kind == 'sleep' else 'poi',
+            'gmaps_id': gmaps_id,
+            'lat': point[0],
+            'lng': point[1],
+            'link titles': 'n',
+            'links': 'n',
+        })
+
+    return rows, places
@@ -1,8 +1,10 @@
 import folium
+from folium.plugins import MarkerCluster
 import os
 import googlemaps
 import numpy as np
-import tempfile 
+import json
+import hashlib
 
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -10,50 +12,42 @@ from Utility.plotting_functions import *
 from Utility.html_edits import *
 from Utility.classes import Place, RoadTrip
 from Utility.utility_functions import *
+from Utility.geometry import detail_levels, DETAIL_LEVELS
+from Utility.metrics import stage_timer, timed
 
 from dotenv import load_dotenv
-from flask import session
 
 
-def generate_map(map_id, owner_id, rows):
-    
-    load_dotenv()
-    
-    if rows == []:
-        m = folium.Map(location=(30, 10), zoom_start=3)
+# Bump when the rendered output changes so cached renders are not reused
+RENDER_VERSION = 9
 
-    else:
-        all_stops, driving_stops, other_stops = load_from_fb_format(rows)
-        
-        # Create map centered on the first location
-        coords = all_stops.get_all_coords()
-        start = np.mean(coords, axis=0)
-        m = folium.Map(location=start, zoom_start=8)
 
-        # Set up google maps
-        gmaps_key = os.environ.get('GOOGLE_MAPS_KEY', '')
-        gmaps = googlemaps.Client(key=gmaps_key)
+# 'folium' draws every stop as its own folium object, 'json' ships the trip as one
+# payload drawn client-side, and 'auto' switches to 'json' for larger trips.
+RENDER_MODE = os.environ.get('MAP_RENDER_MODE', 'auto')
+JSON_RENDER_THRESHOLD = int(os.environ.get('MAP_JSON_RENDER_THRESHOLD', 50))
 
-        # Add pins
-        if driving_stops.places != {}:
-            add_pin(m, driving_stops)
 
-        if other_stops.places != {}:
-            add_pin(m, other_stops)
+def render_mode(rows):
+    if RENDER_MODE == 'auto':
+        return 'json' if len(rows) >= JSON_RENDER_THRESHOLD else 'folium'
+    return RENDER_MODE
 
-        # Drives
-        gmaps_ids = driving_stops.get_all_gmapsids()
-        plot_drives(m, driving_stops, gmaps_ids, coords)
 
-    tf = tempfile.NamedTemporaryFile(prefix=f"map_{map_id}_", suffix=".html", delete=False)
-    tf_no_buttons = tempfile.NamedTemporaryFile(prefix=f"map_{map_id}_no_buttons_", suffix=".html", delete=False)
-    
-    m.save(tf.name)
-    m.save(tf_no_buttons.name)
+# Non-driving stops ('poi'/'sleep') are clustered when there are at least this many
+# of them; MAP_CLUSTER_POIS='on'/'off' forces clustering either way.
+CLUSTER_MODE = os.environ.get('MAP_CLUSTER_POIS', 'auto')
+CLUSTER_THRESHOLD = int(os.environ.get('MAP_CLUSTER_THRESHOLD', 30))
+
 
-    session['last_map_path'] = tf_no_buttons.name
+def cluster_other_stops(rows):
+    if CLUSTER_MODE == 'auto':
+        return len(rows) - len(driving_rows(rows)) >= CLUSTER_THRESHOLD
+    return CLUSTER_MODE == 'on'
 
-    fb_config = {
+
+def firebase_config():
+    return {
         "apiKey": os.environ.get('FIREBASE_API_KEY'),
         "authDomain": os.environ.get('FIREBASE_AUTH_DOMAIN'),
         "projectId": os.environ.get('FIREBASE_PROJECT_ID'),
@@ -62,10 +56,9 @@ def generate_map(map_id, owner_id, rows):
         "appId": os.environ.get('FIREBASE_APP_ID')
     }
 
-    insert_sidebar(tf_no_buttons.name, map_id, owner_id, firebase_config=fb_config)
-    insert_sidebar(tf.name, map_id, owner_id, firebase_config=fb_config)
 
-    buttons = [
+def map_buttons(map_id):
+    return [
         ("Add Marker", f"/add_marker?map_id={map_id}"),
         ("View Locations", "/stops"),
         ("Collaborators", "/collaborate"),
@@ -73,11 +66,96 @@ def generate_map(map_id, owner_id, rows):
         ("See All Roadtrips", "/roadtrips"),
         ("Sign out", "/sign_out")
     ]
-    insert_buttons(tf.name, buttons)
-    
-    tf.close()
+
+
+def map_content_hash(map_id, owner_id, rows, offline=None):
+    """
+    Hash of everything generate_map's output depends on: the stop rows, the ids,
+    the buttons, the sidebar's Firebase config and whether legs are only estimated.
+    """
+    payload = json.dumps({
+        "version": RENDER_VERSION,
+        "offline": ROUTING_OFFLINE if offline is None else offline,
+        "render_mode": render_mode(rows),
+        "cluster": cluster_other_stops(rows),
+        "map_id": map_id,
+        "owner_id": owner_id,
+        "rows": rows,
+        "buttons": map_buttons(map_id),
+        "firebase": firebase_config()
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+@timed('generate_map')
+def generate_map(map_id, owner_id, rows, offline=None):
+    """
+    Renders the map page for these stop rows.
+    Returns (html, download_html, pending): the full page with the sidebar and
+    action buttons and the bare map for downloading, as bytes (the sidebar needs
+    Firebase and a signed-in user, neither of which an offline copy has), and
+    whether any leg was only estimated because Google couldn't be asked (see
+    resolve_legs), in which case the render shouldn't be kept. With
+    offline=True (default: ROUTING_OFFLINE) uncached legs are estimated instead
+    of asking Google.
+    """
+    load_dotenv()
     
-    return tf
+    legs = []
+    if rows == []:
+        m = folium.Map(location=(30, 10), zoom_start=3)
+
+    else:
+        all_stops, driving_stops, other_stops = load_from_fb_format(rows)
+        
+        # Create map centered on the first location
+        coords = all_stops.get_all_coords()
+        start = np.mean(coords, axis=0)
+        m = folium.Map(location=start, zoom_start=8)
+
+        gmaps_ids = driving_stops.get_all_gmapsids()
+
+        if render_mode(rows) == 'json':
+            # One JSON payload drawn by the browser instead of a folium object per stop
+            drive_coords = driving_stops.get_all_coords()
+            legs = route_legs(gmaps_ids, stored_legs(rows), drive_coords, offline)
+            routes = [
+                detail_levels(polyline.decode(leg['polyline'])) if leg['polyline']
+                else [drive_coords[i], drive_coords[(i + 1) % len(drive_coords)]]
+                for i, leg in enumerate(legs)
+            ]
+            payload = trip_payload(driving_stops, other_stops, legs, routes, cluster=cluster_other_stops(rows),
+                                   zooms=[zoom for zoom, _ in DETAIL_LEVELS])
+            TripLayer(payload).add_to(m)
+
+        else:
+            # Add pins
+            if driving_stops.places != {}:
+                add_pin(m, driving_stops)
+
+            # Numbered driving pins stay unclustered so the route order is readable
+            if other_stops.places != {}:
+                if cluster_other_stops(rows):
+                    add_pin(MarkerCluster(options={'maxClusterRadius': 50}).add_to(m), other_stops)
+                else:
+                    add_pin(m, other_stops)
+
+            # Drives (legs stored on the stop documents are reused as-is)
+            legs = plot_drives(m, driving_stops, gmaps_ids, legs=stored_legs(rows), offline=offline)
+
+    # Render once in memory, then assemble both page variants from the same render
+    with stage_timer('folium_render'):
+        page = m.get_root().render()
+
+    with stage_timer('html_inject'):
+        before, after = split_at_body_end(page)
+        sidebar = sidebar_html(map_id, owner_id, firebase_config=firebase_config())
+        buttons = buttons_html(map_buttons(map_id))
+
+        html = "".join((before, sidebar, "\n", buttons, "\n", after)).encode("utf-8")
+        download_html = "".join((before, "\n", after)).encode("utf-8")
+
+    return html, download_html, any(leg.get('pending') for leg in legs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,140 @@
+// static/js/map_renderer.js
+// Builds the markers and route lines of a trip from one compact JSON payload,
+// instead of the server emitting a separate folium object per stop.
+//
+// payload.stops: [lat, lng, number|null, colour, kind, popupHtml]
+// payload.legs:  [path, distance, duration, estimated, routed] where path is an
+//                encoded polyline, a list of [lat, lng] points, or a list of
+//                encoded polylines simplified to each detail level in
+//                payload.zooms; estimated legs have estimated distance/duration,
+//                and legs that aren't routed (a straight line) are drawn dashed
+// payload.zooms: minimum zoom at which each detail level is shown, coarse to fine
+// payload.cluster: when true, un-numbered stops go into a marker cluster group
+//                  (numbered driving pins always stay on the map itself)
+(function () {
+  function decodePolyline(str) {
+    const points = [];
+    let index = 0, lat = 0, lng = 0;
+
+    while (index < str.length) {
+      let result = 0, shift = 0, b;
+      do {
+        b = str.charCodeAt(index++) - 63;
+        result |= (b & 0x1f) << shift;
+        shift += 5;
+      } while (b >= 0x20);
+      lat += (result & 1) ? ~(result >> 1) : (result >> 1);
+
+      result = 0; shift = 0;
+      do {
+        b = str.charCodeAt(index++) - 63;
+        result |= (b & 0x1f) << shift;
+        shift += 5;
+      } while (b >= 0x20);
+      lng += (result & 1) ? ~(result >> 1) : (result >> 1);
+
+      points.push([lat / 1e5, lng / 1e5]);
+    }
+    return points;
+  }
+
+  function numberedPinHtml(number, color) {
+    return '<div style="position: relative; width: 30px; height: 30px; background: ' + color + '; color: white;' +
+      ' border-radius: 50% 50% 50% 0; transform: rotate(-45deg); text-align: center; line-height: 30px; font-weight: bold;">' +
+      '<div style="transform: rotate(45deg); font-size: 14px;">' + number + '</div></div>';
+  }
+
+  function stopIcon(number, colour, kind) {
+    if (number !== null) {
+      return L.divIcon({ html: numberedPinHtml(number, colour), iconSize: [30, 30], iconAnchor: [15, 30], className: 'empty' });
+    }
+    if (kind === 'sleep') {
+      return L.AwesomeMarkers.icon({ icon: 'fa-solid fa-bed', prefix: 'fa', markerColor: colour, iconColor: 'white' });
+    }
+    return L.AwesomeMarkers.icon({ icon: 'info-sign', prefix: 'glyphicon', markerColor: colour, iconColor: 'white' });
+  }
+
+  function legPath(path) {
+    return typeof path === 'string' ? decodePolyline(path) : path;
+  }
+
+  function isLevelled(path) {
+    return Array.isArray(path) && typeof path[0] === 'string';
+  }
+
+  function levelFor(zoom, zooms) {
+    let level = 0;
+    zooms.forEach(function (z, i) {
+      if (zoom >= z) level = i;
+    });
+    return level;
+  }
+
+  function drivePopup(distance, duration, estimated, routed) {
+    let html = '<b>Duration</b>: ' + duration + ' <br> <b>Distance</b>: ' + distance;
+    if (!routed) html += ' <br> <i>No route available, shown as a straight line</i>';
+    if (estimated) html += ' <br> <i>Distance and duration estimated</i>';
+    return html;
+  }
+
+  function renderTrip(map, payload) {
+    let cluster = null;
+    if (payload.cluster && L.markerClusterGroup) {
+      cluster = L.markerClusterGroup({ chunkedLoading: true, maxClusterRadius: 50 });
+    }
+
+    const clustered = [];
+    payload.stops.forEach(function (s) {
+      const marker = L.marker([s[0], s[1]], { icon: stopIcon(s[2], s[3], s[4]) })
+        .bindPopup(s[5], { maxWidth: 300 });
+      if (cluster && s[2] === null) {
+        clustered.push(marker);
+      } else {
+        marker.addTo(map);
+      }
+    });
+    if (cluster) {
+      cluster.addLayers(clustered);
+      map.addLayer(cluster);
+    }
+
+    // Levelled legs are decoded lazily, one detail level at a time
+    const zooms = payload.zooms || [0];
+    let level = levelFor(map.getZoom(), zooms);
+    const levelled = [];
+
+    payload.legs.forEach(function (leg) {
+      const path = leg[0];
+      let points;
+      if (isLevelled(path)) {
+        const decoded = [];
+        const atLevel = function (i) {
+          return decoded[i] || (decoded[i] = decodePolyline(path[i]));
+        };
+        points = atLevel(level);
+        levelled.push({ atLevel: atLevel });
+      } else {
+        points = legPath(path);
+      }
+
+      const line = L.polyline(points, { color: 'blue', weight: 4, opacity: 0.8, dashArray: leg[4] ? null : '8 8' })
+        .bindPopup(drivePopup(leg[1], leg[2], leg[3], leg[4]), { maxWidth: 300 })
+        .addTo(map);
+      if (isLevelled(path)) levelled[levelled.length - 1].line = line;
+    });
+
+    if (levelled.length) {
+      map.on('zoomend', function () {
+        const next = levelFor(map.getZoom(), zooms);
+        if (next === level) return;
+        level = next;
+        levelled.forEach(function (l) {
+          l.line.setLatLngs(l.atLevel(level));
+        });
+      });
+    }
+  }
+
+  window.renderTrip = renderTrip;
+  window.decodePolyline = decodePolyline;
+})();